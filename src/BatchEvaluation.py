@@ -0,0 +1,157 @@
+import chess
+import sys
+import time
+from Evaluation import Evaluation, incrementalTerms, numIncrementalTerms, endgameStartWeight, squareDistances, centerDistances
+from PSQT import pieceValues
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Evaluates many positions at once with NumPy, for tools that score large sets of positions (datasets, opening preparation).
+# Boards become a feature tensor of shape (N, 12, 64): plane color * 6 + pieceType - 1 holds a 1 on every square with
+# such a piece. Material, endgame weights and piece-square sums are one product of that tensor with incrementalTerms;
+# the phase blend, mop-up and king shield weighting are array expressions over the N positions.
+# The pawn structure and shield terms come from Evaluation.PawnKingTerms per board (through its pawn hash).
+# Every operation is done in the same order as Evaluation.Evaluate, so the scores are equal to the scalar ones.
+# numpy is optional for the engine; only this module needs it.
+
+numFeaturePlanes = 12
+
+def RequireNumpy():
+    if np is None:
+        raise ImportError("Batch evaluation needs numpy (pip install numpy)")
+
+# incrementalTerms as an array of shape (2, 6 * 64, numIncrementalTerms), in the feature plane order
+def TermTable():
+    RequireNumpy()
+    table = np.zeros((2, 6 * 64, numIncrementalTerms), dtype=np.int64)
+    for color in chess.COLORS:
+        for pieceType in chess.PIECE_TYPES:
+            for square in chess.SQUARES:
+                table[int(color), (pieceType - 1) * 64 + square] = incrementalTerms[color][pieceType][square]
+    return table
+
+# Piece bitboards of shape (N, 12) and the side to move of shape (N,)
+def BoardsToBitboards(boards):
+    RequireNumpy()
+    rows = []
+    for board in boards:
+        white = board.occupied_co[chess.WHITE]
+        black = board.occupied_co[chess.BLACK]
+        pieces = (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings)
+        rows.append([mask & black for mask in pieces] + [mask & white for mask in pieces])
+    bitboards = np.array(rows, dtype=np.uint64).reshape(len(boards), numFeaturePlanes)
+    turns = np.array([board.turn for board in boards], dtype=bool)
+    return bitboards, turns
+
+# (N, 12) bitboards to the (N, 12, 64) feature tensor
+def BitboardsToFeatures(bitboards):
+    numBoards = bitboards.shape[0]
+    littleEndian = bitboards.astype("<u8", copy=False)
+    return np.unpackbits(littleEndian.view(np.uint8).reshape(numBoards, numFeaturePlanes, 8), axis=2, bitorder="little")
+
+class BatchEvaluation:
+    def __init__(self, evaluation: Evaluation = None):
+        RequireNumpy()
+        self.evaluation = evaluation or Evaluation()
+        self.termTable = TermTable()
+        self.squareDistances = np.array(squareDistances, dtype=np.int64)
+        self.centerDistances = np.array(centerDistances, dtype=np.int64)
+
+    # Scores of the boards from the side to move's point of view, as a float64 array
+    def Evaluate(self, boards):
+        if not boards:
+            return np.zeros(0)
+        bitboards, turns = BoardsToBitboards(boards)
+        features = BitboardsToFeatures(bitboards)
+        numBoards = len(boards)
+
+        # Indexed by color as an int (black 0, white 1): sums[n, color, term] like ComputeIncrementalSums
+        colorFeatures = features.reshape(numBoards, 2, 6 * 64).astype(np.int64)
+        sums = np.einsum("ncf,cft->nct", colorFeatures, self.termTable)
+        counts = features.sum(axis=2, dtype=np.int64)
+        colors = (int(chess.BLACK), int(chess.WHITE))
+        kings = [features[:, color * 6 + chess.KING - 1].argmax(axis=1) for color in colors]
+        material = [sums[:, color, 0] for color in colors]
+        endgame = [1 - np.minimum(1, sums[:, color, 1] / endgameStartWeight) for color in colors]
+        rooks = [counts[:, color * 6 + chess.ROOK - 1] for color in colors]
+        queens = [counts[:, color * 6 + chess.QUEEN - 1] for color in colors]
+        # A side's piece-square score is blended by the other side's endgame score
+        pieceSquare = [sums[:, color, 2] * (1 - endgame[1 - color]) + sums[:, color, 3] * endgame[1 - color] for color in colors]
+
+        # (white pawn, black pawn, white shield, black shield, white open file, black open file) per board
+        pawnKingTerms = [self.evaluation.PawnKingTerms(board)[1:] for board in boards]
+
+        totals = [None, None]
+        for color in colors:
+            enemy = 1 - color
+            offset = 0 if color == chess.WHITE else 1
+            pawnScore = np.array([terms[offset] for terms in pawnKingTerms], dtype=np.int64)
+            isCastled = np.array([terms[2 + offset] is not None for terms in pawnKingTerms])
+            shieldPenalty = np.array([terms[2 + offset] or 0 for terms in pawnKingTerms], dtype=np.int64)
+            openFilePenalty = np.array([terms[4 + offset] for terms in pawnKingTerms], dtype=np.int64)
+
+            # Mop-up: drive the enemy king to the edge when ahead in material
+            mopUp = (14 - self.squareDistances[kings[color], kings[enemy]]) * 4 + self.centerDistances[kings[enemy]] * 10
+            mopUp = np.where((material[color] > material[enemy] + 2 * pieceValues[chess.PAWN]) & (endgame[enemy] > 0), mopUp * endgame[enemy], 0)
+
+            uncastledKingPenalty = np.where(isCastled, 0, 50 * np.clip((pieceSquare[enemy] + 10) / 130.0, 0, 1))
+            openFilePenalty = np.where((rooks[enemy] > 1) | ((rooks[enemy] == 1) & (queens[enemy] > 0)), openFilePenalty, 0)
+            shieldWeight = np.where(queens[enemy] == 0, (1 - endgame[enemy]) * 0.6, 1 - endgame[enemy])
+            shield = np.trunc((-shieldPenalty - uncastledKingPenalty - openFilePenalty) * shieldWeight)
+            shield = np.where(endgame[enemy] >= 1, 0, shield)
+
+            totals[color] = material[color] + mopUp + pieceSquare[color] + pawnScore + shield
+
+        return np.where(turns, 1, -1) * (totals[chess.WHITE] - totals[chess.BLACK])
+
+    # Reads an EPD file chunkSize positions at a time and yields (boards, operations, scores) for every chunk,
+    # so only one chunk is held in memory
+    def EvaluateEpdFile(self, path, chunkSize=4096):
+        boards = []
+        operations = []
+        with open(path) as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                board, ops = chess.Board.from_epd(line)
+                boards.append(board)
+                operations.append(ops)
+                if len(boards) == chunkSize:
+                    yield boards, operations, self.Evaluate(boards)
+                    boards = []
+                    operations = []
+        if boards:
+            yield boards, operations, self.Evaluate(boards)
+
+
+# python BatchEvaluation.py file.epd [chunkSize]  prints the score of every position
+# python BatchEvaluation.py                      compares batch and scalar evaluation on the Evaluation sample positions
+if __name__ == "__main__":
+    batch = BatchEvaluation()
+    if len(sys.argv) > 1:
+        chunkSize = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+        for boards, operations, scores in batch.EvaluateEpdFile(sys.argv[1], chunkSize):
+            for board, score in zip(boards, scores):
+                print(f"{board.epd()} {score:.2f}")
+        exit()
+
+    from Evaluation import evaluationPositions
+    boards = []
+    for fen in evaluationPositions:
+        board = chess.Board(fen)
+        for move in board.legal_moves:
+            board.push(move)
+            boards.append(board.copy(stack=False))
+            board.pop()
+    scalar = Evaluation()
+    startTime = time.perf_counter()
+    scalarScores = [scalar.Evaluate(board) for board in boards]
+    scalarSeconds = time.perf_counter() - startTime
+    startTime = time.perf_counter()
+    batchScores = batch.Evaluate(boards)
+    batchSeconds = time.perf_counter() - startTime
+    numDifferent = sum(1 for a, b in zip(scalarScores, batchScores) if a != b)
+    print(f"{len(boards)} positions, {numDifferent} differ; scalar {int(len(boards) / scalarSeconds)} evals/s, batch {int(len(boards) / batchSeconds)} evals/s")
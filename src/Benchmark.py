@@ -0,0 +1,172 @@
+import chess
+import argparse
+import inspect
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+# Importing the searcher changes the working directory, so command line paths are resolved against this one
+launchDirectory = os.getcwd()
+from Searcher import Searcher
+
+# Deterministic benchmark: fixed positions, fixed depth, fixed hash size and cleared tables before every position,
+# so the total node count is a signature of the search. A change that is meant to be a pure speedup must keep it.
+# The timed run is followed by an instrumented run that counts calls and time spent in the main components.
+
+benchPositions = [
+    chess.STARTING_FEN,
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 1",
+    "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+    "2r3k1/pp3ppp/4p3/3pP3/3P4/P4N2/1P3PPP/2R3K1 b - - 0 1",
+    "r1bqkb1r/pp3ppp/2n1pn2/2pp4/3P4/2PBPN2/PP3PPP/RNBQK2R w KQkq - 0 6",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "8/5pk1/6p1/3P4/2K5/8/5PPP/8 w - - 0 1",
+]
+benchDepth = 4
+benchHashMB = 16
+
+
+def CreateSearcher(depth, hashMB):
+    searcher = Searcher(chess.Board())
+    searcher.printInfo = False
+    searcher.SetTranspositionTableSize(hashMB)
+    searcher.SetSearchLimits(depth)
+    return searcher
+
+def SearchPosition(searcher: Searcher, fen):
+    searcher.board = chess.Board(fen)
+    searcher.transpositionTable.Clear()
+    searcher.moveOrderer.Clear()
+    searcher.StartSearch(threading.Event())
+    return searcher.searchDiagnostics.numPositionsEvaluated, searcher.bestMove
+
+# Replaces owner.<name> on the instance with a wrapper that counts calls and their inclusive time.
+# Recursive calls are counted but only the outermost one is timed; for a generator the time of every step is summed.
+def Instrument(owner, name, stats):
+    function = getattr(owner, name)
+    entry = stats[name] = {"calls": 0, "seconds": 0.0}
+    nesting = [0]
+
+    def TimedSteps(generator):
+        while True:
+            startTime = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                entry["seconds"] += time.perf_counter() - startTime
+                return
+            entry["seconds"] += time.perf_counter() - startTime
+            yield item
+
+    if inspect.isgeneratorfunction(function):
+        def GeneratorWrapper(*args, **kwargs):
+            entry["calls"] += 1
+            return TimedSteps(function(*args, **kwargs))
+        setattr(owner, name, GeneratorWrapper)
+        return
+
+    def Wrapper(*args, **kwargs):
+        entry["calls"] += 1
+        if nesting[0]:
+            return function(*args, **kwargs)
+        nesting[0] += 1
+        startTime = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            entry["seconds"] += time.perf_counter() - startTime
+            nesting[0] -= 1
+    setattr(owner, name, Wrapper)
+
+def RunBenchmark(depth=benchDepth, hashMB=benchHashMB, positions=benchPositions, components=True):
+    searcher = CreateSearcher(depth, hashMB)
+    result = {"depth": depth, "hashMB": hashMB, "positions": []}
+    totalNodes = 0
+    startTime = time.perf_counter()
+    for fen in positions:
+        positionStartTime = time.perf_counter()
+        nodes, bestMove = SearchPosition(searcher, fen)
+        seconds = time.perf_counter() - positionStartTime
+        totalNodes += nodes
+        result["positions"].append({"fen": fen, "nodes": nodes, "bestmove": bestMove.uci(), "ms": int(seconds * 1000)})
+    seconds = max(time.perf_counter() - startTime, 1e-6)
+    result["nodes"] = totalNodes
+    result["ms"] = int(seconds * 1000)
+    result["nps"] = int(totalNodes / seconds)
+
+    if components:
+        stats = {}
+        searcher = CreateSearcher(depth, hashMB)
+        Instrument(searcher.evaluation, "Evaluate", stats)
+        Instrument(searcher.moveOrderer, "OrderMoves", stats)
+        Instrument(searcher.moveOrderer, "PickMoves", stats)
+        Instrument(searcher, "QuiescenceSearch", stats)
+        Instrument(searcher.transpositionTable, "LookupEvaluation", stats)
+        Instrument(searcher.transpositionTable, "StoreEvaluation", stats)
+        Instrument(searcher.transpositionTable, "TryGetStoredMove", stats)
+        instrumentedStartTime = time.perf_counter()
+        for fen in positions:
+            SearchPosition(searcher, fen)
+        instrumentedSeconds = time.perf_counter() - instrumentedStartTime
+        for name, entry in stats.items():
+            entry["us_per_call"] = round(entry["seconds"] * 1e6 / max(1, entry["calls"]), 2)
+            entry["calls_per_second"] = int(entry["calls"] / entry["seconds"]) if entry["seconds"] else 0
+            entry["share"] = round(entry["seconds"] / instrumentedSeconds, 3)
+            entry["seconds"] = round(entry["seconds"], 3)
+        result["components"] = stats
+    return result
+
+def PrintResult(result):
+    for position in result["positions"]:
+        print(f"{position['nodes']:>9} nodes {position['ms']:>7} ms  {position['bestmove']:6} {position['fen']}")
+    if "components" in result:
+        print("\ncomponent            calls     us/call   calls/s  share of instrumented run")
+        for name, entry in result["components"].items():
+            print(f"{name:18} {entry['calls']:>9} {entry['us_per_call']:>9.2f} {entry['calls_per_second']:>9} {entry['share']:>6.1%}")
+    print(f"\nTotal time (ms) : {result['ms']}")
+    print(f"Nodes searched  : {result['nodes']}")
+    print(f"Nodes/second    : {result['nps']}")
+
+# Differences to an earlier run: a changed node count means the search itself changed, not only its speed
+def CompareResults(old, new):
+    if old["depth"] != new["depth"] or old["hashMB"] != new["hashMB"] or [p["fen"] for p in old["positions"]] != [p["fen"] for p in new["positions"]]:
+        print("Runs use different settings or positions; only speed is comparable")
+    elif old["nodes"] != new["nodes"]:
+        print(f"Node signature changed: {old['nodes']} -> {new['nodes']}")
+    else:
+        print(f"Node signature unchanged: {new['nodes']}")
+    print(f"nps {old['nps']} -> {new['nps']} ({new['nps'] / max(1, old['nps']) - 1:+.1%})")
+    for name, entry in new.get("components", {}).items():
+        oldEntry = old.get("components", {}).get(name)
+        if oldEntry:
+            print(f"{name:18} us/call {oldEntry['us_per_call']:.2f} -> {entry['us_per_call']:.2f}")
+
+def GitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OBSIDIAN search benchmark")
+    parser.add_argument("--depth", type=int, default=benchDepth)
+    parser.add_argument("--hash", type=int, default=benchHashMB, help="transposition table size in MB")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with the results of an earlier --json run")
+    parser.add_argument("--no-components", action="store_true", help="skip the instrumented per-component run")
+    args = parser.parse_args()
+
+    result = RunBenchmark(args.depth, args.hash, components=not args.no_components)
+    result["commit"] = GitCommit()
+    result["python"] = platform.python_version()
+    PrintResult(result)
+    if args.json:
+        with open(os.path.join(launchDirectory, args.json), "w") as file:
+            json.dump(result, file, indent=2)
+    if args.compare:
+        with open(os.path.join(launchDirectory, args.compare)) as file:
+            print()
+            CompareResults(json.load(file), result)
@@ -3,6 +3,7 @@ import math
 import os
 import chess.polyglot
 from Searcher import Searcher
+from LazySMP import LazySMP
 import threading
 import time
 import pkg_resources
@@ -16,46 +17,155 @@ class Bot:
         self.useMaxThinkTime = False
         self.maxThinkTimeMs = 2500
         self.isThinking = False
+        self.numThreads = 1
+        self.smp = None
+        self.searchThread = None
+        self.searchLimits = (0, None)
+        self.isPondering = False
+        self.holdInfinite = False
+        self.holdBestMove = False
+        self.bestMoveReleased = threading.Event()
         
-    def ChooseThinkTime(self, timeRemainingWhiteMs, timeRemainingBlackMs, incrementWhiteMs, incrementBlackMs):
+    # Returns the (soft, hard) time limits in ms for a search on the clock
+    def ChooseThinkTime(self, timeRemainingWhiteMs, timeRemainingBlackMs, incrementWhiteMs, incrementBlackMs, movesToGo=0):
         board = self.board
         myTimeRemainingMs = timeRemainingWhiteMs if board.turn == chess.WHITE else timeRemainingBlackMs
         myIncrementMs = incrementWhiteMs if board.turn == chess.WHITE else incrementBlackMs
-        return math.ceil(min(myTimeRemainingMs / 40 + myIncrementMs, myTimeRemainingMs / 2 - 1))
+        return self.searcher.timeManager.AllocateFromClock(myTimeRemainingMs, myIncrementMs, movesToGo)
         
-    
-    def ThinkTimed(self, timeMs):
+    # With only timeMs given the search uses exactly that long ('go movetime'), timeMs None means no time limit.
+    # With a separate maxTimeMs, timeMs is a soft budget that the time manager may shorten or extend up to maxTimeMs.
+    # When pondering, the search runs without limit until ponderhit starts the clock or stop ends it.
+    # An infinite search only sends its bestmove after stop.
+    # Searches run in the background; the call returns as soon as the search has started.
+    def ThinkTimed(self, timeMs, maxTimeMs=None, ponder=False, infinite=False, maxDepth=256, maxNodes=0, mateInMoves=0):
+        self.StopThinking()
         self.isThinking = True
+        self.searcher.SetSearchLimits(maxDepth, maxNodes, mateInMoves)
+        # The opening book is not used while pondering or analysing
+        if ponder or infinite:
+            self.StartSearch(timeMs, maxTimeMs, ponder, infinite)
+            return
         try:
             binary_data = pkg_resources.resource_filename(__name__, "Titans.bin")
-            move = chess.polyglot.MemoryMappedReader(binary_data).weighted_choice(self.board).move
-            self.searcher.bestMove = move
-                
-            print("bestmove", move.uci())
-        except:
-            self.StartSearch(timeMs)
+            with chess.polyglot.open_reader(binary_data) as reader:
+                move = reader.weighted_choice(self.board).move
+        except (IndexError, OSError):
+            # Out of book (IndexError) or no readable book file
+            self.StartSearch(timeMs, maxTimeMs, ponder, infinite)
+            return
+        self.searcher.bestMove = move
+        print("bestmove", move.uci())
+        self.isThinking = False
             
     def StopThinking(self):
         if self.isThinking:
             self.searcher.EndSearch()
-            self.isThinking = False
+            if self.smp:
+                self.smp.StopSearch()
+        # A ponder or infinite search that already finished is waiting for this to send its bestmove
+        self.holdBestMove = False
+        self.bestMoveReleased.set()
+        if self.searchThread is not None and self.searchThread is not threading.current_thread():
+            self.searchThread.join()
+            self.searchThread = None
+
+    # The opponent played the expected move: keep searching, now on our own clock
+    def PonderHit(self):
+        if not self.isPondering:
+            return
+        self.isPondering = False
+        self.StartClock(*self.searchLimits)
+        if not self.holdInfinite:
+            self.holdBestMove = False
+            self.bestMoveReleased.set()
+
+    def StartClock(self, timeMs, maxTimeMs):
+        if timeMs is None:
+            self.searcher.timeManager.Start()
+        elif maxTimeMs is None:
+            self.searcher.timeManager.StartMoveTime(timeMs)
+        else:
+            self.searcher.timeManager.Start(timeMs, maxTimeMs, adaptive=True)
     
-    def StartSearch(self, timeMs):
+    def StartSearch(self, timeMs, maxTimeMs=None, ponder=False, infinite=False):
         self.searcher.board = self.board
-        event = threading.Event()
+        self.searchLimits = (timeMs, maxTimeMs)
+        self.isPondering = ponder
+        self.holdInfinite = infinite
+        self.holdBestMove = ponder or infinite
+        self.bestMoveReleased.clear()
+        if ponder or infinite:
+            self.searcher.timeManager.Start()
+        else:
+            self.StartClock(timeMs, maxTimeMs)
+        self.searcher.searchCancelled = False
+        generation = self.searcher.transpositionTable.NewSearch()
+        if self.smp:
+            self.smp.StartSearch(self.board, generation, self.searcher.maxDepth)
+        self.searchThread = threading.Thread(target=self.RunSearch, args=(generation,), daemon=True)
+        self.searchThread.start()
+
+    def RunSearch(self, generation):
         copy = self.board.copy()
-        thread1 = threading.Thread(target=self.searcher.StartSearch, args=(event,))
-        thread2 = threading.Thread(target=self.StopThinking)
-        thread1.start()
-        event.wait(timeMs // 1000)
-        thread2.start()
+        self.searcher.StartSearch(threading.Event(), generation)
+        if self.holdBestMove:
+            # The GUI must not receive a bestmove before ponderhit or stop, even when the search ended on its own
+            self.bestMoveReleased.wait()
+        if self.smp:
+            self.smp.StopSearch()
+        self.isThinking = False
         move, eval = self.searcher.GetSearchResult()
+        if self.smp:
+            # Play the deepest completed iteration of any process
+            helperDepth, helperMove, helperEval = self.smp.CollectResults()
+            if helperDepth > self.searcher.CurrentDepth and helperMove in copy.legal_moves:
+                move, eval = helperMove, helperEval
         if move == chess.Move.null():
             movesList = list(copy.legal_moves)
             self.searcher.moveOrderer.OrderMoves(chess.Move.null(), copy, movesList, False, 0)
             move = movesList[0]
-        print("bestmove", move.uci())
+        ponderMove = self.searcher.GetPonderMove(move)
+        if ponderMove:
+            print("bestmove", move.uci(), "ponder", ponderMove.uci())
+        else:
+            print("bestmove", move.uci())
         
+    def SetDebugMode(self, enabled):
+        self.searcher.SetDebugMode(enabled)
+
+    def SetHashSize(self, sizeMB):
+        self.StopHelpers()
+        self.searcher.SetTranspositionTableSize(sizeMB)
+        self.SetThreads(self.numThreads)
+
+    def SetEvalCacheSize(self, sizeMB):
+        self.StopHelpers()
+        self.searcher.SetEvalCacheSize(sizeMB)
+        self.SetThreads(self.numThreads)
+
+    # With more than one thread the transposition table moves to shared memory and numThreads - 1 helper processes join the search
+    def SetThreads(self, numThreads):
+        self.StopHelpers()
+        self.numThreads = numThreads
+        if numThreads > 1:
+            if not self.searcher.transpositionTable.shared:
+                self.searcher.UseSharedTranspositionTable()
+            tt = self.searcher.transpositionTable
+            self.smp = LazySMP(numThreads - 1, tt.SharedName(), tt.sizeMB, self.searcher.evaluation.evalCache.sizeMB)
+        elif self.searcher.transpositionTable.shared:
+            self.searcher.transpositionTable.SetShared(False)
+
+    def StopHelpers(self):
+        if self.smp:
+            self.smp.Shutdown()
+            self.smp = None
+
+    def Quit(self):
+        self.StopThinking()
+        self.StopHelpers()
+        self.searcher.transpositionTable.Close()
+
     def NotifyNewGame(self):
         self.board.reset()
         self.searcher.ClearForNewPosition()
\ No newline at end of file
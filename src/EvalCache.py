@@ -0,0 +1,50 @@
+from array import array
+
+# Static evaluations by zobrist key, in front of Evaluation.Evaluate.
+# Two flat arrays: keys[i] holds the full key, scores[i] the evaluation from the side to move's point of view,
+# so an entry takes 16 bytes and the configured size in MB is the real size.
+# The table is direct mapped and lossy: a store always replaces what was in its slot.
+# A size of 0 MB disables the cache.
+evalEntrySizeBytes = 16
+
+class EvalCache:
+    def __init__(self, sizeMB=8):
+        self.numHits = 0
+        self.numMisses = 0
+        self.Resize(sizeMB)
+
+    def Resize(self, sizeMB):
+        self.sizeMB = sizeMB
+        numEntries = sizeMB * 1024 * 1024 // evalEntrySizeBytes
+        # Rounded down to a power of two so the index is the low bits of the key
+        self.numEntries = 1 << (numEntries.bit_length() - 1) if numEntries else 0
+        self.indexMask = self.numEntries - 1
+        self.Clear()
+
+    def Clear(self):
+        self.keys = array('Q', bytes(8 * self.numEntries))
+        self.scores = array('d', bytes(8 * self.numEntries))
+
+    def ResetCounters(self):
+        self.numHits = self.numMisses = 0
+
+    # The stored score for the key, or None
+    def Probe(self, key):
+        if not self.numEntries:
+            return None
+        index = key & self.indexMask
+        if self.keys[index] == key:
+            self.numHits += 1
+            return self.scores[index]
+        self.numMisses += 1
+        return None
+
+    def Store(self, key, score):
+        if not self.numEntries:
+            return
+        index = key & self.indexMask
+        self.keys[index] = key
+        self.scores[index] = score
+
+    def HitRate(self):
+        return self.numHits / max(1, self.numHits + self.numMisses)
@@ -1,41 +1,97 @@
 import chess
+import sys
+import time
 from PSQT import *
+from PawnHash import PawnHash
+from EvalCache import EvalCache
+from Zobrist import PawnKingKey
 
 # Performs static evaluation of the current position.
 # The position is assumed to be 'quiet', i.e no captures are available that could drastically affect the evaluation.
 # The score that's returned is given from the perspective of whoever's turn it is to move.
 # So a positive score means the player who's turn it is to move has an advantage, while a negative score indicates a disadvantage.
 
+# Endgame Transition (0->1)
+queenEndgameWeight = 45
+rookEndgameWeight = 20
+bishopEndgameWeight = 10
+knightEndgameWeight = 10
+endgameStartWeight = 2 * rookEndgameWeight + 2 * bishopEndgameWeight + 2 * knightEndgameWeight + queenEndgameWeight
+endgameWeights = [0, 0, knightEndgameWeight, bishopEndgameWeight, rookEndgameWeight, queenEndgameWeight, 0]
+
+# The part of the evaluation that is a plain sum over the pieces, kept per color as
+#   [material, endgame weight, piece-square score (middlegame), piece-square score (endgame)]
+# so that it can be updated on every move instead of recomputed (see Position).
+# incrementalTerms[color][pieceType][square] is the contribution of one piece. Pawns and kings have separate
+# middlegame and endgame tables; the other pieces count the same in both.
+numIncrementalTerms = 4
+incrementalTerms = [[[(0, 0, 0, 0)] * 64 for _ in range(7)] for _ in range(2)]
+for color in chess.COLORS:
+    for square in chess.SQUARES:
+        incrementalTerms[color][chess.PAWN][square] = (pieceValues[chess.PAWN], 0, Pawns[square], PawnsEnd[square])
+        incrementalTerms[color][chess.KING][square] = (0, 0, King[square], KingEnd[square])
+        for pieceType, table in ((chess.KNIGHT, Knights), (chess.BISHOP, Bishops), (chess.ROOK, Rooks), (chess.QUEEN, Queens)):
+            incrementalTerms[color][pieceType][square] = (pieceValues[pieceType], endgameWeights[pieceType], table[square], table[square])
+
+# Precomputed bitboards and distances for the pawn structure, king shield and mop-up terms
+# adjacentFileMasks[file]: the files either side of the file
+adjacentFileMasks = [(chess.BB_FILES[file - 1] if file > 0 else 0) | (chess.BB_FILES[file + 1] if file < 7 else 0) for file in range(8)]
+# passedPawnMasks[color][square]: squares in front of a pawn of that color on its own and the adjacent files.
+# With no enemy pawn there, the pawn is passed.
+passedPawnMasks = [[0] * 64 for _ in range(2)]
+for square in chess.SQUARES:
+    spanFiles = chess.BB_FILES[chess.square_file(square)] | adjacentFileMasks[chess.square_file(square)]
+    rank = chess.square_rank(square)
+    passedPawnMasks[chess.WHITE][square] = spanFiles & ~((1 << (8 * rank + 8)) - 1) & chess.BB_ALL
+    passedPawnMasks[chess.BLACK][square] = spanFiles & ((1 << (8 * rank)) - 1)
+# kingShields[color][kingSquare]: one (front square mask, mask of the square behind it on the same file, penalty when
+# both are empty, penalty when only the square behind holds a pawn) per file next to and on the king's file.
+# The front square is one rank ahead of the king, the one behind two ranks ahead.
+# kingPawnShieldScores holds the front penalties for the files left, on and right of the king, then the ones behind.
+kingShields = [[[] for _ in range(64)] for _ in range(2)]
+for color in chess.COLORS:
+    direction = 1 if color == chess.WHITE else -1
+    for square in chess.SQUARES:
+        file = chess.square_file(square)
+        frontRank = chess.square_rank(square) + direction
+        behindRank = frontRank + direction
+        if not 0 <= frontRank <= 7:
+            continue
+        for i, fileOffset in enumerate((-1, 0, 1)):
+            if 0 <= file + fileOffset <= 7:
+                behindMask = chess.BB_SQUARES[chess.square(file + fileOffset, behindRank)] if 0 <= behindRank <= 7 else 0
+                kingShields[color][square].append((chess.BB_SQUARES[chess.square(file + fileOffset, frontRank)], behindMask,
+                                                   kingPawnShieldScores[i], kingPawnShieldScores[i + 3]))
+squareDistances = [[chess.square_distance(a, b) for b in chess.SQUARES] for a in chess.SQUARES]
+centerDistances = [min(squareDistances[square][center] for center in (chess.E4, chess.D4, chess.E5, chess.D5)) for square in chess.SQUARES]
+
+# Sums of incrementalTerms for both colors, indexed [color * numIncrementalTerms + term]
+def ComputeIncrementalSums(board: chess.Board):
+    sums = [0] * (2 * numIncrementalTerms)
+    for color in chess.COLORS:
+        base = color * numIncrementalTerms
+        for pieceType in chess.PIECE_TYPES:
+            terms = incrementalTerms[color][pieceType]
+            for square in chess.scan_forward(board.pieces_mask(pieceType, color)):
+                for i, value in enumerate(terms[square]):
+                    sums[base + i] += value
+    return sums
+
 class MaterialInfo:
-    def __init__(self, board: chess.Board, isWhite:bool):
-        self.pawns = len(board.pieces(chess.PAWN, isWhite))
-        self.knights = len(board.pieces(chess.KNIGHT, isWhite))
-        self.bishops = len(board.pieces(chess.BISHOP, isWhite))
-        self.rooks = len(board.pieces(chess.ROOK, isWhite))
-        self.queens = len(board.pieces(chess.QUEEN, isWhite))
-        self.myPawns = board.pieces(chess.PAWN, isWhite)
-        self.enemyPawns = board.pieces(chess.PAWN, not isWhite)
+    def __init__(self, board: chess.Board, isWhite:bool, incrementalSums):
+        own = board.occupied_co[isWhite]
+        self.pawns = chess.popcount(board.pawns & own)
+        self.knights = chess.popcount(board.knights & own)
+        self.bishops = chess.popcount(board.bishops & own)
+        self.rooks = chess.popcount(board.rooks & own)
+        self.queens = chess.popcount(board.queens & own)
         
         self.numMajors = self.queens + self.rooks
         self.numMinors = self.knights + self.bishops
         
-        self.materialScore = 0
-        self.materialScore += self.pawns * pieceValues[chess.PAWN]
-        self.materialScore += self.knights * pieceValues[chess.KNIGHT]
-        self.materialScore += self.bishops * pieceValues[chess.BISHOP]
-        self.materialScore += self.rooks * pieceValues[chess.ROOK]
-        self.materialScore += self.queens * pieceValues[chess.QUEEN]
-        
-        # Endgame Transition (0->1)
-        queenEndgameWeight = 45
-        rookEndgameWeight = 20
-        bishopEndgameWeight = 10
-        knightEndgameWeight = 10
-        
-        endgameStartWeight = 2 * rookEndgameWeight + 2 * bishopEndgameWeight + 2 * knightEndgameWeight + queenEndgameWeight
-        endgameWeightSum = self.queens * queenEndgameWeight + self.rooks * rookEndgameWeight + self.bishops * bishopEndgameWeight + self.knights * knightEndgameWeight
-        
-        self.endgameScore = 1 - min(1, endgameWeightSum / endgameStartWeight)
+        base = isWhite * numIncrementalTerms
+        self.materialScore = incrementalSums[base]
+        self.endgameScore = 1 - min(1, incrementalSums[base + 1] / endgameStartWeight)
 
 class EvalData:
     def __init__(self):
@@ -51,40 +107,29 @@ class EvalData:
          
        
 class Evaluation:
+    def __init__(self):
+        # Recompute the incremental sums of every Position evaluated and fail if they differ (debug mode)
+        self.verifyIncremental = False
+        # Pawn structure and king shield terms, cached by the pawn and king key
+        self.usePawnHash = True
+        self.pawnHash = PawnHash()
+        # Whole evaluations, cached by the zobrist key of the position
+        self.evalCache = EvalCache()
+
     def MaterialScore(self, board, isWhite):
-        m = MaterialInfo(board, isWhite)
+        m = MaterialInfo(board, isWhite, ComputeIncrementalSums(board))
         return m.materialScore
 
-    def EvaluatePieceSquareTable(self, board, isWhite, endgameScore):
-        
-        def EvaluatePiece(pieceType, pieceSquareTable):
-            score = 0
-            for square in board.pieces(pieceType, isWhite):
-                score += pieceSquareTable[square]
-            return score
-        
-        score = 0
-        
-        score += EvaluatePiece(chess.KNIGHT, Knights)
-        score += EvaluatePiece(chess.BISHOP, Bishops)
-        score += EvaluatePiece(chess.ROOK, Rooks)
-        score += EvaluatePiece(chess.QUEEN, Queens)
-        
-        pawnEarly = EvaluatePiece(chess.PAWN, Pawns)
-        pawnEnd = EvaluatePiece(chess.PAWN, PawnsEnd)
-        score += pawnEarly * (1 - endgameScore) + pawnEnd * endgameScore
-        
-        kingEarly = EvaluatePiece(chess.KING, King)
-        kingEnd = EvaluatePiece(chess.KING, KingEnd)
-        score += kingEarly * (1 - endgameScore) + kingEnd * endgameScore
-        return score
+    def EvaluatePieceSquareTable(self, isWhite, endgameScore, incrementalSums):
+        base = isWhite * numIncrementalTerms
+        return incrementalSums[base + 2] * (1 - endgameScore) + incrementalSums[base + 3] * endgameScore
         
     def EndgamePhaseWeight(self, materialCountWithoutPawns):
         multiplier = 1 / endgameMaterialStart
         return 1 - min(1, multiplier * materialCountWithoutPawns)
 
     def distanceToCenterSquares(self, square):
-        return min(chess.square_distance(square, chess.E4), chess.square_distance(square, chess.D4), chess.square_distance(square, chess.E5), chess.square_distance(square, chess.D5))
+        return centerDistances[square]
      
     
     # As game transitions to endgame, and if up material, then encourage moving king closer to opponent king    
@@ -95,38 +140,27 @@ class Evaluation:
             friendKing = board.king(isWhite)
             enemyKing = board.king(not isWhite)
             # Encourage moving king closer to opponent king
-            score += (14 - chess.square_distance(friendKing, enemyKing)) * 4
+            score += (14 - squareDistances[friendKing][enemyKing]) * 4
             # Encourage pushing opponent king to edge of board
             score += self.distanceToCenterSquares(enemyKing) * 10
             return score * enemyMaterial.endgameScore
         
         return 0
 
+    # Passed pawns by how far they are from promotion, plus a penalty by the number of isolated pawns
     def EvaluatePawn(self, board: chess.Board, isWhite):
-        fpanws = set(chess.square_file(sq) for sq in board.pieces(chess.PAWN, isWhite))
-        epawnsFiles = set(chess.square_file(sq) for sq in board.pieces(chess.PAWN, not isWhite))
-
-        # Is passed pawn
-        def passedPawn():
-            score = 0
-            for sq in fpanws:
-                if sq not in epawnsFiles:
-                    rank = chess.square_rank(sq) if not isWhite else 6 - chess.square_rank(sq)
-                    score += passedPawnBonuses[rank]
-            return score
-        
-        # Is isolated pawn
-        def isolatedPawn():
-            cnt = 0
-            for sq in fpanws:
-                file = chess.square_file(sq)
-                if file - 1 not in fpanws and file + 1 not in fpanws:
-                    cnt += 1
-                    
-            return isolatedPawnPenaltyByCount[cnt]
-        
-        
-        return passedPawn() + isolatedPawn()
+        pawns = board.pawns & board.occupied_co[isWhite]
+        enemyPawns = board.pawns & board.occupied_co[not isWhite]
+        passedMasks = passedPawnMasks[isWhite]
+        score = 0
+        numIsolatedPawns = 0
+        for square in chess.scan_forward(pawns):
+            if not enemyPawns & passedMasks[square]:
+                rank = square >> 3
+                score += passedPawnBonuses[7 - rank if isWhite else rank]
+            if not pawns & adjacentFileMasks[square & 7]:
+                numIsolatedPawns += 1
+        return score + isolatedPawnPenaltyByCount[numIsolatedPawns]
                 
     def Clamp(self, x, min, max):
         if x < min:
@@ -135,85 +169,146 @@ class Evaluation:
             return max
         return x
 
-    def KingPawnSheild(self, board: chess.Board, isWhite: bool, enemyMaterial:MaterialInfo, enemyPieceSquareScore):
-        enemyMaterial = MaterialInfo(board, not isWhite)
+    # The part of the king safety term that only depends on the pawns and the king:
+    # the squared shield penalty (None while the king is on the middle files) and the open file penalty
+    def KingShieldTerms(self, board: chess.Board, isWhite: bool):
+        friendlyPawns = board.pawns & board.occupied_co[isWhite]
+        enemyPawns = board.pawns & board.occupied_co[not isWhite]
+        king = board.king(isWhite)
+        kingFile = king & 7
+        
+        penalty = None
+        if kingFile <= 2 or kingFile >= 5:
+            penalty = 0
+            for mask, behindMask, score, behindScore in kingShields[isWhite][king]:
+                if not friendlyPawns & mask:
+                    penalty += behindScore if friendlyPawns & behindMask else score
+            penalty *= penalty
+            
+        openFileAgainstKingPenalty  = 0
+        clampedKingFile = self.Clamp(kingFile, 1, 6)
+        for attack in range(clampedKingFile, clampedKingFile+2):
+            isKingFile = attack == kingFile
+            if not enemyPawns & chess.BB_FILES[attack]:
+                openFileAgainstKingPenalty += 25 if isKingFile else 15
+                if not friendlyPawns & chess.BB_FILES[attack]:
+                    openFileAgainstKingPenalty += 15 if isKingFile else 10
+        return penalty, openFileAgainstKingPenalty
+
+    def KingPawnSheild(self, board: chess.Board, isWhite: bool, enemyMaterial:MaterialInfo, enemyPieceSquareScore, shieldPenalty, openFilePenalty):
         if enemyMaterial.endgameScore >= 1:
             return 0
         
         penalty = 0
-        friendlyPawns = board.pieces(chess.PAWN, isWhite)
-        king = board.king(isWhite)
-        kingFile = chess.square_file(king)
         uncastleKingPenalty = 0
-        
-        shieldWhite = shieldBlack = []
-        sq = king
-        rank = chess.square_rank(sq)
-        file = chess.square_file(sq)
-        for fileOffset in range(-1, 2):
-            if file + fileOffset >= 0 and file + fileOffset <= 7 and rank + 1 >= 0 and rank + 1 <= 7:
-                shieldWhite.append(chess.square(file + fileOffset, rank + 1))
-                shieldBlack.append(chess.square(file + fileOffset, rank - 1))
-
-        for fileOffset in range(-1, 2):
-            if file + fileOffset >= 0 and file + fileOffset <= 7 and rank + 2 >= 0 and rank + 2 <= 7:
-                shieldWhite.append(chess.square(file + fileOffset, rank + 2))
-                shieldBlack.append(chess.square(file + fileOffset, rank - 2))
-        
-        if kingFile <= 2 or kingFile >= 5:
-            squares = shieldWhite if isWhite else shieldBlack
-            for i in range(len(squares) // 2):
-                sq = squares[i]
-                if sq not in friendlyPawns:
-                    if len(squares) > 3 and i + 3 < len(squares) and squares[i + 3] in friendlyPawns and (i+3 < len(kingPawnShieldScores)):
-                        penalty += kingPawnShieldScores[i + 3]
-                    else:
-                        penalty += kingPawnShieldScores[i]
-            penalty *= penalty
+        if shieldPenalty is not None:
+            penalty = shieldPenalty
         else:
             enemyDevelopementScore = self.Clamp((enemyPieceSquareScore + 10) / 130.0, 0, 1)
             uncastleKingPenalty = 50 * enemyDevelopementScore
             
         openFileAgainstKingPenalty  = 0
-        epawnsFiles = set(chess.square_file(sq) for sq in board.pieces(chess.PAWN, not isWhite))
-        fpawnsFiles = set(chess.square_file(sq) for sq in board.pieces(chess.PAWN, isWhite))
         if enemyMaterial.rooks > 1 or (enemyMaterial.rooks == 1 and enemyMaterial.queens > 0):
-            clampedKingFile = self.Clamp(kingFile, 1, 6)
-            for attack in range(clampedKingFile, clampedKingFile+2):
-                isKingFile = attack == kingFile
-                if attack not in epawnsFiles:
-                    openFileAgainstKingPenalty += 25 if isKingFile else 15
-                    if attack not in fpawnsFiles:
-                        openFileAgainstKingPenalty += 15 if isKingFile else 10
+            openFileAgainstKingPenalty = openFilePenalty
         pawnShieldWeight = 1 - enemyMaterial.endgameScore
-        if (len(board.pieces(chess.QUEEN, not isWhite)) == 0):
+        if enemyMaterial.queens == 0:
             pawnShieldWeight *= 0.6
             
         return (int)((-penalty - uncastleKingPenalty - openFileAgainstKingPenalty) * pawnShieldWeight)
 
-    def Evaluate(self, board):
+    # Entry of the pawn hash for the board's pawns and kings:
+    # (key, white pawn score, black pawn score, white shield penalty, black shield penalty, white open file penalty, black open file penalty)
+    def PawnKingTerms(self, board: chess.Board):
+        key = getattr(board, "pawnKingKey", None)
+        if key is None:
+            key = PawnKingKey(board)
+        elif self.verifyIncremental and key != PawnKingKey(board):
+            raise AssertionError(f"Incremental pawn and king key {key:016x} differs from {PawnKingKey(board):016x} in {board.fen()}")
+        if self.usePawnHash:
+            entry = self.pawnHash.Probe(key)
+            if entry is not None:
+                return entry
+        whiteShieldPenalty, whiteOpenFilePenalty = self.KingShieldTerms(board, True)
+        blackShieldPenalty, blackOpenFilePenalty = self.KingShieldTerms(board, False)
+        terms = (self.EvaluatePawn(board, True), self.EvaluatePawn(board, False), whiteShieldPenalty, blackShieldPenalty, whiteOpenFilePenalty, blackOpenFilePenalty)
+        if self.usePawnHash:
+            return self.pawnHash.Store(key, terms)
+        return (key,) + terms
+
+    # Given the zobrist key of the board, the score is looked up in the eval cache first and stored there after evaluating
+    def Evaluate(self, board, key=None):
+        if key is None:
+            return self.EvaluateWithoutCache(board)
+        score = self.evalCache.Probe(key)
+        if score is None:
+            score = self.EvaluateWithoutCache(board)
+            self.evalCache.Store(key, score)
+        elif self.verifyIncremental and score != self.EvaluateWithoutCache(board):
+            raise AssertionError(f"Cached evaluation {score} differs from {self.EvaluateWithoutCache(board)} for key {key:016x} in {board.fen()}")
+        return score
+
+    # A Position carries its incremental sums; any other board has them computed here
+    def EvaluateWithoutCache(self, board):
+        incrementalSums = getattr(board, "incrementalSums", None)
+        if incrementalSums is None:
+            incrementalSums = ComputeIncrementalSums(board)
+        elif self.verifyIncremental and incrementalSums != ComputeIncrementalSums(board):
+            raise AssertionError(f"Incremental evaluation sums {incrementalSums} differ from {ComputeIncrementalSums(board)} in {board.fen()}")
         whiteEval = EvalData()
         blackEval = EvalData()
-        whiteMaterial = MaterialInfo(board, True)
-        blackMaterial = MaterialInfo(board, False)
+        whiteMaterial = MaterialInfo(board, True, incrementalSums)
+        blackMaterial = MaterialInfo(board, False, incrementalSums)
         
         # Score based on number (and type) of pieces on board
         whiteEval.materialScore = whiteMaterial.materialScore
         blackEval.materialScore = blackMaterial.materialScore
         
         # Score based on positions of pieces
-        whiteEval.pieceSquareScore = self.EvaluatePieceSquareTable(board, True, blackMaterial.endgameScore)
-        blackEval.pieceSquareScore = self.EvaluatePieceSquareTable(board, False, whiteMaterial.endgameScore)
+        whiteEval.pieceSquareScore = self.EvaluatePieceSquareTable(True, blackMaterial.endgameScore, incrementalSums)
+        blackEval.pieceSquareScore = self.EvaluatePieceSquareTable(False, whiteMaterial.endgameScore, incrementalSums)
         
         # Encourage using own king to push enemy king to edge of board in winning endgame
         whiteEval.mopUpScore = self.MopUpEval(board, True, whiteMaterial, blackMaterial)
         blackEval.mopUpScore = self.MopUpEval(board, False, blackMaterial, whiteMaterial)
         
-        whiteEval.pawnScore = self.EvaluatePawn(board, True)
-        blackEval.pawnScore = self.EvaluatePawn(board, False)
+        _, whiteEval.pawnScore, blackEval.pawnScore, whiteShieldPenalty, blackShieldPenalty, whiteOpenFilePenalty, blackOpenFilePenalty = self.PawnKingTerms(board)
         
-        whiteEval.pawnShieldScore = self.KingPawnSheild(board, True, blackMaterial, blackEval.pieceSquareScore)
-        blackEval.pawnShieldScore = self.KingPawnSheild(board, False, whiteMaterial, whiteEval.pieceSquareScore)
+        whiteEval.pawnShieldScore = self.KingPawnSheild(board, True, blackMaterial, blackEval.pieceSquareScore, whiteShieldPenalty, whiteOpenFilePenalty)
+        blackEval.pawnShieldScore = self.KingPawnSheild(board, False, whiteMaterial, whiteEval.pieceSquareScore, blackShieldPenalty, blackOpenFilePenalty)
         
         pres = 1 if board.turn else -1
         return pres * (whiteEval.Sum() - blackEval.Sum())
+
+
+# Evaluation speed: python Evaluation.py [seconds]
+# Evaluates every position one move away from the sample positions, without the eval cache, with the pawn hash off and on.
+evaluationPositions = [
+    chess.STARTING_FEN,
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 1",
+    "2r3k1/pp3ppp/4p3/3pP3/3P4/P4N2/1P3PPP/2R3K1 b - - 0 1",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "8/5pk1/6p1/3P4/2K5/8/5PPP/8 w - - 0 1",
+]
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    boards = []
+    for fen in evaluationPositions:
+        board = chess.Board(fen)
+        for move in board.legal_moves:
+            board.push(move)
+            boards.append(board.copy(stack=False))
+            board.pop()
+    evaluation = Evaluation()
+    for usePawnHash in (False, True):
+        evaluation.usePawnHash = usePawnHash
+        evaluation.pawnHash.Clear()
+        numEvaluations = 0
+        startTime = time.perf_counter()
+        while time.perf_counter() - startTime < seconds:
+            for board in boards:
+                evaluation.EvaluateWithoutCache(board)
+            numEvaluations += len(boards)
+        elapsed = time.perf_counter() - startTime
+        print(f"{len(boards)} positions, pawn hash {'on ' if usePawnHash else 'off'}: {int(numEvaluations / elapsed)} evals/s, {elapsed * 1e6 / numEvaluations:.1f} us per eval")
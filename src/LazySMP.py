@@ -0,0 +1,131 @@
+import chess
+import multiprocessing
+import queue
+import threading
+import time
+import sys
+from Searcher import Searcher
+
+# Lazy SMP: helper processes search the same root as the main searcher and share its transposition table.
+# Python threads cannot run the search in parallel, so every helper is a separate process.
+# Odd helpers start their iterative deepening one ply deeper so the processes do not search in lockstep,
+# and every helper reports its completed iterations so the main process can play the deepest result.
+
+def HelperMain(helperId, sharedName, sizeMB, evalCacheSizeMB, stopFlag, commands, results):
+    searcher = Searcher(chess.Board(), sizeMB, sharedName)
+    searcher.SetEvalCacheSize(evalCacheSizeMB)
+    searcher.stopSignal = stopFlag
+    searcher.printInfo = False
+    searcher.startDepth = 1 + helperId % 2
+    searcher.iterationCallback = lambda depth, move, eval: results.put((helperId, depth, move.uci(), eval))
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        rootFen, moves, maxDepth, generation = command
+        board = chess.Board(rootFen)
+        for move in moves:
+            board.push_uci(move)
+        searcher.board = board
+        searcher.maxDepth = maxDepth
+        searcher.StartSearch(threading.Event(), generation)
+        results.put((helperId, -1, None, 0))
+
+    searcher.transpositionTable.Close()
+
+
+class LazySMP:
+    def __init__(self, numHelpers, sharedName, sizeMB, evalCacheSizeMB=8):
+        context = multiprocessing.get_context("spawn")
+        self.numHelpers = numHelpers
+        self.stopFlag = context.RawValue('b', 0)
+        self.results = context.Queue()
+        self.commands = [context.Queue() for _ in range(numHelpers)]
+        self.helpers = [context.Process(target=HelperMain, args=(i + 1, sharedName, sizeMB, evalCacheSizeMB, self.stopFlag, self.commands[i], self.results), daemon=True) for i in range(numHelpers)]
+        for helper in self.helpers:
+            helper.start()
+
+    def StartSearch(self, board: chess.Board, generation, maxDepth=256):
+        self.stopFlag.value = 0
+        rootFen = board.root().fen()
+        moves = [move.uci() for move in board.move_stack]
+        for commands in self.commands:
+            commands.put((rootFen, moves, maxDepth, generation))
+
+    def StopSearch(self):
+        self.stopFlag.value = 1
+
+    # Waits for every helper to finish its search and returns the deepest completed (depth, move, eval) among them.
+    # A helper process that died can never report, so it counts as finished; with no helper result the depth is 0
+    # and the caller keeps the main searcher's move.
+    def CollectResults(self, pollSeconds=0.1):
+        bestDepth, bestMove, bestEval = 0, chess.Move.null(), 0
+        finished = set()
+        while len(finished) < self.numHelpers:
+            try:
+                helperId, depth, move, eval = self.results.get(timeout=pollSeconds)
+            except queue.Empty:
+                finished.update(i + 1 for i, helper in enumerate(self.helpers) if not helper.is_alive())
+                continue
+            if depth < 0:
+                finished.add(helperId)
+            elif depth > bestDepth:
+                bestDepth, bestMove, bestEval = depth, chess.Move.from_uci(move), eval
+        return bestDepth, bestMove, bestEval
+
+    def Shutdown(self):
+        self.StopSearch()
+        for commands in self.commands:
+            commands.put(None)
+        for helper in self.helpers:
+            helper.join()
+
+
+# Time-to-depth benchmark: python LazySMP.py [maxThreads] [depth]
+benchmarkPositions = [
+    "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 1",
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "2r3k1/pp3ppp/4p3/3pP3/3P4/P4N2/1P3PPP/2R3K1 w - - 0 1",
+    "8/5pk1/6p1/3P4/2K5/8/5PPP/8 w - - 0 1",
+]
+
+def TimeToDepth(numThreads, depth):
+    searcher = Searcher(chess.Board())
+    searcher.printInfo = False
+    searcher.maxDepth = depth
+    smp = None
+    if numThreads > 1:
+        searcher.UseSharedTranspositionTable()
+        smp = LazySMP(numThreads - 1, searcher.transpositionTable.SharedName(), searcher.transpositionTableSizeMB)
+
+    totalSeconds = 0
+    for fen in benchmarkPositions:
+        searcher.board = chess.Board(fen)
+        searcher.transpositionTable.Clear()
+        searcher.moveOrderer.Clear()
+        startTime = time.perf_counter()
+        generation = searcher.transpositionTable.NewSearch()
+        if smp:
+            smp.StartSearch(searcher.board, generation, depth)
+        searcher.StartSearch(threading.Event(), generation)
+        if smp:
+            smp.StopSearch()
+            smp.CollectResults()
+        totalSeconds += time.perf_counter() - startTime
+
+    if smp:
+        smp.Shutdown()
+    searcher.transpositionTable.Close()
+    return totalSeconds
+
+if __name__ == "__main__":
+    maxThreads = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    baseSeconds = None
+    numThreads = 1
+    while numThreads <= maxThreads:
+        seconds = TimeToDepth(numThreads, depth)
+        baseSeconds = baseSeconds or seconds
+        print(f"threads {numThreads} depth {depth} time {seconds:.2f}s speedup {baseSeconds / seconds:.2f}")
+        numThreads *= 2
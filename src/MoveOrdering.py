@@ -1,11 +1,72 @@
 import chess
-from TranspositionTable import TT
+from array import array
+from TranspositionTable import TT, EncodeMove, DecodeMove
 from PSQT import *
 from Helpers import *
+from StaticExchange import SEE
 
 def GetPieceValue(pieceType: chess.PieceType):
     return pieceValues[pieceType]
 
+# Squares attacked by the given pawns
+def PawnAttacksMask(pawns, color: chess.Color):
+    if color == chess.WHITE:
+        return (((pawns & ~chess.BB_FILE_A) << 7) | ((pawns & ~chess.BB_FILE_H) << 9)) & chess.BB_ALL
+    return ((pawns & ~chess.BB_FILE_A) >> 9) | ((pawns & ~chess.BB_FILE_H) >> 7)
+
+# Squares attacked by the knights, sliders and king of the given color
+def PieceAttacksMask(board: chess.Board, color: chess.Color):
+    occupied = board.occupied
+    own = board.occupied_co[color]
+    attacks = chess.BB_KING_ATTACKS[chess.msb(board.kings & own)] if board.kings & own else 0
+    for square in chess.scan_reversed(board.knights & own):
+        attacks |= chess.BB_KNIGHT_ATTACKS[square]
+    for square in chess.scan_reversed((board.bishops | board.queens) & own):
+        attacks |= chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+    for square in chess.scan_reversed((board.rooks | board.queens) & own):
+        attacks |= chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied] | chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied]
+    return attacks
+
+# Squares the opponent of the side to move attacks with pawns, and with its other pieces; computed once per node
+def OpponentAttacks(board: chess.Board):
+    opponent = not board.turn
+    return PawnAttacksMask(board.pawns & board.occupied_co[opponent], opponent), PieceAttacksMask(board, opponent)
+
+# Piece-square gain of moving a piece (not a pawn or king) to toSq, less a penalty when the target square is attacked
+def PositionalMoveScore(pieceType: chess.PieceType, color: chess.Color, fromSq, toSq, oppPawnAttacks, oppAttacks):
+    score = TablePSQT[pieceType][color][toSq] - TablePSQT[pieceType][color][fromSq]
+    toMask = chess.BB_SQUARES[toSq]
+    if toMask & oppPawnAttacks:
+        score -= 50
+    elif toMask & oppAttacks:
+        score -= 25
+    return score
+
+# Legal captures (en passant included) and promotions
+def GenerateNoisyMoves(board: chess.Board):
+    moves = list(board.generate_legal_captures())
+    promotingPawns = board.pawns & board.occupied_co[board.turn] & (chess.BB_RANK_7 if board.turn == chess.WHITE else chess.BB_RANK_2)
+    if promotingPawns:
+        promotionSquares = (chess.BB_RANK_8 if board.turn == chess.WHITE else chess.BB_RANK_1) & ~board.occupied
+        moves.extend(board.generate_legal_moves(promotingPawns, promotionSquares))
+    return moves
+
+def HistoryIndex(color: chess.Color, move: chess.Move):
+    return (color << 12) | (move.from_square << 6) | move.to_square
+
+# Colored piece and target square of a move, 0..767
+def PieceToIndex(color: chess.Color, pieceType: chess.PieceType, toSquare):
+    return (((color * 6) + pieceType - 1) << 6) | toSquare
+
+# Yields the moves highest score first, finding each one only when it is asked for
+def PickBest(moves, scores):
+    for i in range(len(moves)):
+        best = max(range(i, len(moves)), key=scores.__getitem__)
+        if best != i:
+            moves[i], moves[best] = moves[best], moves[i]
+            scores[i], scores[best] = scores[best], scores[i]
+        yield moves[i]
+
 class Killer:
     def __init__(self):
         self.moveA = chess.Move.null()
@@ -18,6 +79,10 @@ class Killer:
             
     def Match(self, move: chess.Move):
         return move == self.moveA or move == self.moveB
+
+    def Clear(self):
+        self.moveA = chess.Move.null()
+        self.moveB = chess.Move.null()
     
 
 class MoveOrdering:
@@ -40,38 +105,74 @@ class MoveOrdering:
         self.tt = tt
         self.invalidMove = chess.Move.null()
         self.killerMoves = [Killer() for i in range(self.maxKillerMovePly)]
-        self.History = [[[0] * 64 for i in range(64)] for _ in range(2)]
+        # Butterfly history, History[HistoryIndex(color, move)]. Bonuses and maluses are applied with gravity,
+        # which keeps every entry within +-maxHistory, and the table is aged between searches instead of reset.
+        self.maxHistory = 16384
+        self.History = array('i', bytes(4 * 2 * 64 * 64))
+        # Continuation history: how good a quiet move was after a given move one or two plies earlier,
+        # indexed by PieceToIndex(earlier move) * 768 + PieceToIndex(this move)
+        self.ContinuationHistory = array('i', bytes(4 * 768 * 768))
+        # The quiet move that last refuted each move, by from/to of the refuted move (encoded as in the TT)
+        self.CounterMoves = array('H', bytes(2 * 64 * 64))
+        # Nodes that went through PickMoves and the moves that had to be scored there
+        self.numNodesPicked = 0
+        self.numMovesScored = 0
         
+    # Between searches: history is kept but halved, so the new position's statistics take over quickly
+    def AgeHistory(self):
+        history = self.History
+        for i in range(len(history)):
+            history[i] >>= 1
+
     def ClearHistory(self):
-        self.History = [[[0] * 64 for i in range(64)] for _ in range(2)]
+        self.History = array('i', bytes(4 * 2 * 64 * 64))
+        self.ContinuationHistory = array('i', bytes(4 * 768 * 768))
+        self.CounterMoves = array('H', bytes(2 * 64 * 64))
         
     def ClearKillers(self):
-        self.killerMoves = [Killer() for i in range(self.maxKillerMovePly)]
+        for killer in self.killerMoves:
+            killer.Clear()
         
     def Clear(self):
         self.ClearHistory()
         self.ClearKillers()
+
+    # Updates killers, counter move and history after a quiet move caused a beta cutoff.
+    # The quiet moves searched before it get the same amount as a malus.
+    # Must be called with the board in the node's position; continuationIndices are PieceToIndex of the moves
+    # one and two plies earlier (-1 when unknown).
+    def UpdateQuietStats(self, board: chess.Board, move: chess.Move, depth, ply, quietsSearched, prevMove: chess.Move, continuationIndices):
+        if ply < self.maxKillerMovePly:
+            self.killerMoves[ply].Add(move)
+        if prevMove:
+            self.CounterMoves[(prevMove.from_square << 6) | prevMove.to_square] = EncodeMove(move)
+
+        bonus = min(depth * depth, 1200)
+        self.UpdateHistory(board, move, bonus, continuationIndices)
+        for quiet in quietsSearched:
+            self.UpdateHistory(board, quiet, -bonus, continuationIndices)
+
+    def UpdateHistory(self, board: chess.Board, move: chess.Move, bonus, continuationIndices):
+        maxHistory = self.maxHistory
+        history = self.History
+        index = HistoryIndex(board.turn, move)
+        history[index] += bonus - history[index] * abs(bonus) // maxHistory
+        pieceTo = PieceToIndex(board.turn, board.piece_type_at(move.from_square), move.to_square)
+        continuationHistory = self.ContinuationHistory
+        for previous in continuationIndices:
+            if previous >= 0:
+                index = previous * 768 + pieceTo
+                continuationHistory[index] += bonus - continuationHistory[index] * abs(bonus) // maxHistory
+
+    def CounterMove(self, prevMove: chess.Move):
+        if not prevMove:
+            return chess.Move.null()
+        return DecodeMove(self.CounterMoves[(prevMove.from_square << 6) | prevMove.to_square])
         
+    # Sorts moves best first and returns the set of captures (other than the hash move) that lose material in the exchange
     def OrderMoves(self, hashMove: chess.Move, board: chess.Board, moves, inQSearch, ply):
-        pawnAttacks = []
-        oppPawnAttacks = []
-        oppAttacks = []
-        for sq in board.pieces(chess.PAWN, board.turn):
-            legal_moves_pawns = filter(lambda move: move.from_square == sq, moves)
-            pawnAttacks.extend(legal_moves_pawns)
-        for sq in board.pieces(chess.PAWN, not board.turn):
-            legal_moves_pawns = filter(lambda move: move.from_square == sq, moves)
-            oppPawnAttacks.extend([move.to_square for move in legal_moves_pawns])
-        
-        for sq in (
-            board.pieces(chess.ROOK, not board.turn) |
-            board.pieces(chess.KNIGHT, not board.turn) |
-            board.pieces(chess.BISHOP, not board.turn) |
-            board.pieces(chess.QUEEN, not board.turn) |
-            board.pieces(chess.KING, not board.turn)
-        ):
-            legal_moves = filter(lambda move: move.from_square == sq, moves)
-            oppAttacks.extend([move.to_square for move in legal_moves])
+        oppPawnAttacks, oppAttacks = OpponentAttacks(board)
+        losingCaptures = set()
         for i, move in enumerate(moves):
             if move == hashMove:
                 self.moveScores[i] = self.hashMoveScore
@@ -91,11 +192,13 @@ class MoveOrdering:
             
             if isCapture:
                 captureMaterialDelta  = GetPieceValue(capturedPiece) - pieceValue
-                opponentCanRecapture = board.attackers(not board.turn, toSq) != 0
-                if opponentCanRecapture:
-                    score += captureMaterialDelta + (self.winningCaptureBias if captureMaterialDelta >= 0 else self.losingCaptureBias)
+                # The exchange decides whether the capture wins material, the victim and attacker order it within its group
+                score += captureMaterialDelta
+                if SEE(board, move) >= 0:
+                    score += self.winningCaptureBias
                 else:
-                    score += self.winningCaptureBias + captureMaterialDelta
+                    score += self.losingCaptureBias
+                    losingCaptures.add(move)
                     
                 
             if movePieceType == chess.PAWN:
@@ -104,23 +207,100 @@ class MoveOrdering:
             elif movePieceType == chess.KING:
                 pass
             else:
-                toScore = TablePSQT[movePieceType][movePiece.color][toSq]
-                fromScore = TablePSQT[movePieceType][movePiece.color][fromSq]
-                score += toScore - fromScore
-                
-                if toSq in oppPawnAttacks:
-                    score -= 50
-                elif toSq in oppAttacks:
-                    score -= 25
+                score += PositionalMoveScore(movePieceType, movePiece.color, fromSq, toSq, oppPawnAttacks, oppAttacks)
         
             if not isCapture:
                 isKiller = not inQSearch and ply < self.maxKillerMovePly and self.killerMoves[ply].Match(move)
                 score += self.killerBias if isKiller else self.regularBias
-                score += self.History[board.turn][move.from_square][move.to_square]
+                score += self.History[HistoryIndex(board.turn, move)]
                 
             self.moveScores[i] = score
         Quicksort(moves, self.moveScores, 0, len(moves) - 1)
+        return losingCaptures
         
+    # Staged move generation for the main search. Moves are generated and scored one group at a time and picked
+    # best first on demand, so a node that fails high early never generates or scores the remaining groups:
+    #   hash move, good captures and queen promotions, killers and the counter move, quiet moves,
+    #   losing captures and under-promotions.
+    # The board must be back in the node's position whenever the next move is requested.
+    def PickMoves(self, hashMove: chess.Move, board: chess.Board, ply, prevMove=chess.Move.null(), continuationIndices=(-1, -1)):
+        self.numNodesPicked += 1
+        if hashMove and board.is_legal(hashMove):
+            yield hashMove
+        else:
+            hashMove = chess.Move.null()
+
+        turn = board.turn
+        goodNoisy, goodScores, badNoisy, badScores = [], [], [], []
+        for move in GenerateNoisyMoves(board):
+            if move == hashMove:
+                continue
+            capturedPieceType = board.piece_type_at(move.to_square)
+            score = GetPieceValue(capturedPieceType) - GetPieceValue(board.piece_type_at(move.from_square)) if capturedPieceType else 0
+            if move.promotion == chess.QUEEN:
+                score += GetPieceValue(chess.QUEEN)
+            elif move.promotion:
+                badNoisy.append(move)
+                badScores.append(score - GetPieceValue(chess.QUEEN))
+                continue
+            exchangeValue = SEE(board, move) if capturedPieceType else 0
+            if exchangeValue >= 0:
+                goodNoisy.append(move)
+                goodScores.append(score)
+            else:
+                badNoisy.append(move)
+                badScores.append(exchangeValue)
+        self.numMovesScored += len(goodNoisy) + len(badNoisy)
+        yield from PickBest(goodNoisy, goodScores)
+
+        killers = []
+        if ply < self.maxKillerMovePly:
+            killer = self.killerMoves[ply]
+            for move in (killer.moveA, killer.moveB):
+                if move and move != hashMove and not move.promotion and not board.is_capture(move) and board.is_legal(move):
+                    killers.append(move)
+                    yield move
+        counterMove = self.CounterMove(prevMove)
+        if counterMove and counterMove != hashMove and counterMove not in killers and not counterMove.promotion and not board.is_capture(counterMove) and board.is_legal(counterMove):
+            killers.append(counterMove)
+            yield counterMove
+
+        oppPawnAttacks, oppAttacks = OpponentAttacks(board)
+        history = self.History
+        continuationHistory = self.ContinuationHistory
+        colorIndex = turn << 12
+        continuation1 = continuationIndices[0] * 768 if continuationIndices[0] >= 0 else -1
+        continuation2 = continuationIndices[1] * 768 if continuationIndices[1] >= 0 else -1
+        quiets, quietScores = [], []
+        for move in self.GenerateQuietMoves(board):
+            if move == hashMove or move in killers:
+                continue
+            fromSq = move.from_square
+            toSq = move.to_square
+            pieceType = board.piece_type_at(fromSq)
+            score = history[colorIndex | (fromSq << 6) | toSq]
+            pieceTo = PieceToIndex(turn, pieceType, toSq)
+            if continuation1 >= 0:
+                score += continuationHistory[continuation1 + pieceTo]
+            if continuation2 >= 0:
+                score += continuationHistory[continuation2 + pieceTo]
+            if pieceType != chess.PAWN and pieceType != chess.KING:
+                score += PositionalMoveScore(pieceType, turn, fromSq, toSq, oppPawnAttacks, oppAttacks)
+            quiets.append(move)
+            quietScores.append(score)
+        self.numMovesScored += len(quiets)
+        yield from PickBest(quiets, quietScores)
+
+        yield from PickBest(badNoisy, badScores)
+
+    # Legal moves that neither capture nor promote. Castling is generated with the king's moves.
+    def GenerateQuietMoves(self, board: chess.Board):
+        ownPawns = board.pawns & board.occupied_co[board.turn]
+        promotionRank = chess.BB_RANK_8 if board.turn == chess.WHITE else chess.BB_RANK_1
+        epMask = chess.BB_SQUARES[board.ep_square] if board.ep_square is not None else 0
+        yield from board.generate_legal_moves(~ownPawns & chess.BB_ALL, ~board.occupied_co[not board.turn] & chess.BB_ALL)
+        yield from board.generate_legal_moves(ownPawns, ~(board.occupied | promotionRank | epMask) & chess.BB_ALL)
+
     def GetScore(self, index):
         score = self.moveScores[index]  
         scoreTypes = [self.hashMoveScore, self.winningCaptureBias, self.losingCaptureBias, self.promoteBias, self.killerMoves, self.regularBias]
@@ -134,4 +314,20 @@ class MoveOrdering:
                 typeName = typeNames[i]
         
         return f"{score} ({typeName})"
-    
\ No newline at end of file
+    
+
+# Ordering cost per node: python MoveOrdering.py [iterations]
+if __name__ == "__main__":
+    import sys
+    import time
+    from StaticExchange import benchmarkPositions
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    orderer = MoveOrdering(TT(1))
+    cases = [(board, list(board.legal_moves)) for board in map(chess.Board, benchmarkPositions)]
+    startTime = time.perf_counter()
+    for _ in range(iterations):
+        for board, moves in cases:
+            orderer.OrderMoves(chess.Move.null(), board, list(moves), False, 0)
+    seconds = time.perf_counter() - startTime
+    numMoves = sum(len(moves) for _, moves in cases)
+    print(f"OrderMoves: {seconds * 1e6 / (iterations * len(cases)):.1f} us per node, {seconds * 1e6 / (iterations * numMoves):.2f} us per move")
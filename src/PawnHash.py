@@ -0,0 +1,40 @@
+# Cache of the evaluation terms that only depend on where the pawns and kings stand, indexed by the pawn and king
+# zobrist key (Zobrist.PawnKingKey). Pawn structure changes on few moves, so sibling nodes and whole subtrees of
+# piece moves share one entry.
+# An entry is a tuple (key, terms...): always replaced, looked up by the low bits of the key and checked against the key.
+# The number of entries is rounded down to a power of two.
+
+class PawnHash:
+    def __init__(self, numEntries=1 << 14):
+        self.numHits = 0
+        self.numMisses = 0
+        self.Resize(numEntries)
+
+    def Resize(self, numEntries):
+        numEntries = max(1, numEntries)
+        self.numEntries = 1 << (numEntries.bit_length() - 1)
+        self.indexMask = self.numEntries - 1
+        self.entries = [None] * self.numEntries
+
+    def Clear(self):
+        self.entries = [None] * self.numEntries
+
+    def ResetCounters(self):
+        self.numHits = self.numMisses = 0
+
+    # The terms stored for the key, or None
+    def Probe(self, key):
+        entry = self.entries[key & self.indexMask]
+        if entry is not None and entry[0] == key:
+            self.numHits += 1
+            return entry
+        self.numMisses += 1
+        return None
+
+    def Store(self, key, terms):
+        entry = (key,) + terms
+        self.entries[key & self.indexMask] = entry
+        return entry
+
+    def HitRate(self):
+        return self.numHits / max(1, self.numHits + self.numMisses)
@@ -0,0 +1,115 @@
+import chess
+import argparse
+import multiprocessing
+import time
+from Position import Position
+from Zobrist import FullKey, PushWithKey
+
+# Move generation counts (perft) with a per-root-move breakdown (divide).
+# The optional cache maps (zobrist key, depth) to the node count below a position, so transpositions are counted once.
+# Root moves can be split over a process pool; every worker counts the subtrees of its root moves with its own cache.
+
+def Perft(board: chess.Board, depth, key=0, cache=None):
+    if depth <= 1:
+        return board.legal_moves.count() if depth == 1 else 1
+    if cache is not None:
+        nodes = cache.get((key, depth))
+        if nodes is not None:
+            return nodes
+
+    nodes = 0
+    for move in list(board.generate_legal_moves()):
+        if cache is not None:
+            nodes += Perft(board, depth - 1, PushWithKey(board, key, move), cache)
+        else:
+            board.push(move)
+            nodes += Perft(board, depth - 1)
+        board.pop()
+
+    if cache is not None:
+        cache[(key, depth)] = nodes
+    return nodes
+
+def PerftRootMove(fen, moveUci, depth, useCache):
+    board = Position(chess.Board(fen))
+    move = chess.Move.from_uci(moveUci)
+    if useCache:
+        return Perft(board, depth - 1, PushWithKey(board, FullKey(board), move), {})
+    board.push(move)
+    return Perft(board, depth - 1)
+
+# Returns [(move, nodes)] for every legal root move
+def Divide(board: chess.Board, depth, useCache=False, numProcesses=1):
+    fen = board.fen()
+    moves = list(board.legal_moves)
+    if depth < 1:
+        return []
+    if numProcesses > 1 and len(moves) > 1:
+        with multiprocessing.get_context("spawn").Pool(min(numProcesses, len(moves))) as pool:
+            counts = pool.starmap(PerftRootMove, [(fen, move.uci(), depth, useCache) for move in moves])
+        return list(zip(moves, counts))
+
+    position = Position(board)
+    key = FullKey(position)
+    cache = {} if useCache else None
+    results = []
+    for move in moves:
+        if useCache:
+            nodes = Perft(position, depth - 1, PushWithKey(position, key, move), cache)
+        else:
+            position.push(move)
+            nodes = Perft(position, depth - 1)
+        position.pop()
+        results.append((move, nodes))
+    return results
+
+# Prints the divide in the usual 'move: nodes' format followed by the total
+def PrintDivide(board: chess.Board, depth, useCache=False, numProcesses=1):
+    startTime = time.perf_counter()
+    results = Divide(board, depth, useCache, numProcesses)
+    seconds = max(time.perf_counter() - startTime, 1e-6)
+    for move, nodes in results:
+        print(f"{move.uci()}: {nodes}")
+    totalNodes = sum(nodes for _, nodes in results)
+    print(f"\nNodes searched: {totalNodes}")
+    print(f"Time: {int(seconds * 1000)} ms, {int(totalNodes / seconds)} nodes per second")
+    return totalNodes
+
+
+# Reference counts by depth, starting at depth 1
+standardPositions = [
+    ("startpos", chess.STARTING_FEN, [20, 400, 8902, 197281, 4865609, 119060324]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862, 4085603, 193690690]),
+    ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238, 674624, 11030083]),
+    ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467, 422333, 15833292]),
+    ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379, 2103487, 89941194]),
+    ("position6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", [46, 2079, 89890, 3894594, 164075551]),
+]
+
+# Counts every standard position up to maxDepth and compares with the reference; returns True when all match
+def RunSuite(maxDepth, useCache=False, numProcesses=1):
+    allMatch = True
+    totalNodes = 0
+    startTime = time.perf_counter()
+    for name, fen, expectedCounts in standardPositions:
+        depth = min(maxDepth, len(expectedCounts))
+        nodes = sum(count for _, count in Divide(chess.Board(fen), depth, useCache, numProcesses))
+        totalNodes += nodes
+        matches = nodes == expectedCounts[depth - 1]
+        allMatch = allMatch and matches
+        print(f"{name:10} depth {depth} nodes {nodes:>10} {'ok' if matches else f'FAILED (expected {expectedCounts[depth - 1]})'}")
+    seconds = max(time.perf_counter() - startTime, 1e-6)
+    print(f"total nodes {totalNodes} time {seconds:.2f}s nps {int(totalNodes / seconds)}")
+    return allMatch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Perft / divide for OBSIDIAN's move generation")
+    parser.add_argument("depth", type=int)
+    parser.add_argument("fen", nargs="?", default=chess.STARTING_FEN, help="position to count (default: start position)")
+    parser.add_argument("--suite", action="store_true", help="run the standard positions up to depth and check the known counts")
+    parser.add_argument("--hash", action="store_true", help="cache subtree counts by zobrist key")
+    parser.add_argument("--processes", type=int, default=1, help="split root moves over this many processes")
+    args = parser.parse_args()
+    if args.suite:
+        exit(0 if RunSuite(args.depth, args.hash, args.processes) else 1)
+    PrintDivide(chess.Board(args.fen), args.depth, args.hash, args.processes)
@@ -0,0 +1,272 @@
+import chess
+import sys
+import time
+from Evaluation import incrementalTerms, numIncrementalTerms, ComputeIncrementalSums
+from Zobrist import pieceKeys, PawnKingKey
+
+# Board used by the search.
+# It is a chess.Board, so move generation, attack tests and every query the engine uses come from python-chess,
+# but making and unmaking moves is done here: push() updates the bitboards and a mailbox (piece type per square)
+# in place and records a small undo record, pop() restores from it. python-chess' push/pop build a full board state
+# object per move and rescan the castling rights, which dominated search profiles.
+# The material, endgame weight and piece-square sums of the evaluation (incrementalSums) are updated on every move too,
+# and so is the zobrist key of the pawns and kings (pawnKingKey) that indexes the pawn hash.
+# Only push/pop (and push_uci/push_san, which call push) keep the mailbox in step; editing methods such as
+# set_piece_at or set_fen are not supported. Convert with Position(board) and ToBoard() at the UCI boundary.
+
+class Position(chess.Board):
+    def __init__(self, board: chess.Board = None):
+        super().__init__(None)
+        self.undoStack = []
+        self.mailbox = [None] * 64
+        self.incrementalSums = [0] * (2 * numIncrementalTerms)
+        self.pawnKingKey = 0
+        if board is not None:
+            self.SetFromBoard(board)
+
+    # Copies the position of the board. Its move history is not copied: pop() can only undo moves made on this object.
+    def SetFromBoard(self, board: chess.Board):
+        self.pawns = board.pawns
+        self.knights = board.knights
+        self.bishops = board.bishops
+        self.rooks = board.rooks
+        self.queens = board.queens
+        self.kings = board.kings
+        self.occupied_co = [board.occupied_co[chess.BLACK], board.occupied_co[chess.WHITE]]
+        self.occupied = board.occupied
+        self.promoted = board.promoted
+        self.chess960 = board.chess960
+        self.turn = board.turn
+        self.castling_rights = board.clean_castling_rights()
+        self.ep_square = board.ep_square
+        self.halfmove_clock = board.halfmove_clock
+        self.fullmove_number = board.fullmove_number
+        self.move_stack = []
+        self._stack = []
+        self.undoStack = []
+        self.mailbox = [board.piece_type_at(square) for square in chess.SQUARES]
+        self.incrementalSums = ComputeIncrementalSums(board)
+        self.pawnKingKey = PawnKingKey(board)
+
+    def ToBoard(self):
+        board = chess.Board(None)
+        board.pawns = self.pawns
+        board.knights = self.knights
+        board.bishops = self.bishops
+        board.rooks = self.rooks
+        board.queens = self.queens
+        board.kings = self.kings
+        board.occupied_co = [self.occupied_co[chess.BLACK], self.occupied_co[chess.WHITE]]
+        board.occupied = self.occupied
+        board.promoted = self.promoted
+        board.chess960 = self.chess960
+        board.turn = self.turn
+        board.castling_rights = self.castling_rights
+        board.ep_square = self.ep_square
+        board.halfmove_clock = self.halfmove_clock
+        board.fullmove_number = self.fullmove_number
+        return board
+
+    def copy(self, *, stack=True):
+        return Position(self)
+
+    def piece_type_at(self, square):
+        return self.mailbox[square]
+
+    def TogglePiece(self, pieceType, mask):
+        if pieceType == chess.PAWN:
+            self.pawns ^= mask
+        elif pieceType == chess.KNIGHT:
+            self.knights ^= mask
+        elif pieceType == chess.BISHOP:
+            self.bishops ^= mask
+        elif pieceType == chess.ROOK:
+            self.rooks ^= mask
+        elif pieceType == chess.QUEEN:
+            self.queens ^= mask
+        else:
+            self.kings ^= mask
+
+    def AddTerms(self, color, pieceType, square):
+        sums = self.incrementalSums
+        base = color * numIncrementalTerms
+        material, endgameWeight, middlegame, endgame = incrementalTerms[color][pieceType][square]
+        sums[base] += material
+        sums[base + 1] += endgameWeight
+        sums[base + 2] += middlegame
+        sums[base + 3] += endgame
+
+    def RemoveTerms(self, color, pieceType, square):
+        sums = self.incrementalSums
+        base = color * numIncrementalTerms
+        material, endgameWeight, middlegame, endgame = incrementalTerms[color][pieceType][square]
+        sums[base] -= material
+        sums[base + 1] -= endgameWeight
+        sums[base + 2] -= middlegame
+        sums[base + 3] -= endgame
+
+    # Expects a legal move or a null move, in the same notation python-chess generates
+    def push(self, move: chess.Move):
+        turn = self.turn
+        occupiedCo = self.occupied_co
+        mailbox = self.mailbox
+        epSquare = self.ep_square
+        undo = [move, self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+                occupiedCo[chess.WHITE], occupiedCo[chess.BLACK], self.occupied,
+                self.castling_rights, epSquare, self.halfmove_clock, self.fullmove_number, self.incrementalSums[:], self.pawnKingKey, None]
+        self.undoStack.append(undo)
+        self.move_stack.append(move)
+
+        self.ep_square = None
+        self.halfmove_clock += 1
+        if turn == chess.BLACK:
+            self.fullmove_number += 1
+        self.turn = not turn
+        if not move:
+            undo[-1] = ()
+            return
+
+        fromSq = move.from_square
+        toSq = move.to_square
+        fromMask = chess.BB_SQUARES[fromSq]
+        toMask = chess.BB_SQUARES[toSq]
+        pieceType = mailbox[fromSq]
+        capturedPieceType = mailbox[toSq]
+
+        if pieceType == chess.KING:
+            self.castling_rights &= ~(chess.BB_RANK_1 if turn == chess.WHITE else chess.BB_RANK_8)
+            # Castling: king takes own rook (chess960 notation) or moves two files
+            if occupiedCo[turn] & toMask or abs(toSq - fromSq) == 2:
+                backRank = fromSq & ~7
+                kingSide = toSq > fromSq
+                rookFrom = toSq if occupiedCo[turn] & toMask else backRank + (7 if kingSide else 0)
+                kingTo = backRank + (6 if kingSide else 2)
+                rookTo = backRank + (5 if kingSide else 3)
+                removed = fromMask | chess.BB_SQUARES[rookFrom]
+                added = chess.BB_SQUARES[kingTo] | chess.BB_SQUARES[rookTo]
+                self.kings = (self.kings & ~fromMask) | chess.BB_SQUARES[kingTo]
+                self.rooks = (self.rooks & ~chess.BB_SQUARES[rookFrom]) | chess.BB_SQUARES[rookTo]
+                occupiedCo[turn] = (occupiedCo[turn] & ~removed) | added
+                self.occupied = (self.occupied & ~removed) | added
+                undo[-1] = ((kingTo, None), (rookTo, None), (fromSq, chess.KING), (rookFrom, chess.ROOK))
+                mailbox[fromSq] = mailbox[rookFrom] = None
+                mailbox[kingTo] = chess.KING
+                mailbox[rookTo] = chess.ROOK
+                self.RemoveTerms(turn, chess.KING, fromSq)
+                self.RemoveTerms(turn, chess.ROOK, rookFrom)
+                self.AddTerms(turn, chess.KING, kingTo)
+                self.AddTerms(turn, chess.ROOK, rookTo)
+                self.pawnKingKey ^= pieceKeys[turn][chess.KING][fromSq] ^ pieceKeys[turn][chess.KING][kingTo]
+                return
+
+        self.castling_rights &= ~(fromMask | toMask)
+        undoSquares = ((toSq, capturedPieceType), (fromSq, pieceType))
+        if capturedPieceType:
+            self.TogglePiece(capturedPieceType, toMask)
+            occupiedCo[not turn] ^= toMask
+            self.halfmove_clock = 0
+            self.RemoveTerms(not turn, capturedPieceType, toSq)
+            if capturedPieceType == chess.PAWN:
+                self.pawnKingKey ^= pieceKeys[not turn][chess.PAWN][toSq]
+        if pieceType == chess.PAWN:
+            self.halfmove_clock = 0
+            difference = toSq - fromSq
+            if difference == 16 or difference == -16:
+                self.ep_square = fromSq + difference // 2
+            elif toSq == epSquare and not capturedPieceType:
+                captureSquare = toSq - 8 if turn == chess.WHITE else toSq + 8
+                captureMask = chess.BB_SQUARES[captureSquare]
+                self.pawns ^= captureMask
+                occupiedCo[not turn] ^= captureMask
+                self.occupied ^= captureMask
+                mailbox[captureSquare] = None
+                self.RemoveTerms(not turn, chess.PAWN, captureSquare)
+                self.pawnKingKey ^= pieceKeys[not turn][chess.PAWN][captureSquare]
+                undoSquares += ((captureSquare, chess.PAWN),)
+
+        self.TogglePiece(pieceType, fromMask)
+        placedPieceType = move.promotion or pieceType
+        self.TogglePiece(placedPieceType, toMask)
+        occupiedCo[turn] ^= fromMask | toMask
+        self.occupied = (self.occupied ^ fromMask) | toMask
+        mailbox[fromSq] = None
+        mailbox[toSq] = placedPieceType
+        self.RemoveTerms(turn, pieceType, fromSq)
+        self.AddTerms(turn, placedPieceType, toSq)
+        if pieceType == chess.PAWN or pieceType == chess.KING:
+            self.pawnKingKey ^= pieceKeys[turn][pieceType][fromSq]
+            if placedPieceType == pieceType:
+                self.pawnKingKey ^= pieceKeys[turn][pieceType][toSq]
+        undo[-1] = undoSquares
+
+    def pop(self):
+        (move, self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+         white, black, self.occupied, self.castling_rights, self.ep_square, self.halfmove_clock,
+         self.fullmove_number, self.incrementalSums, self.pawnKingKey, undoSquares) = self.undoStack.pop()
+        self.occupied_co[chess.WHITE] = white
+        self.occupied_co[chess.BLACK] = black
+        self.turn = not self.turn
+        mailbox = self.mailbox
+        for square, pieceType in undoSquares:
+            mailbox[square] = pieceType
+        return self.move_stack.pop()
+
+    # Debug check that the mailbox, the evaluation sums and the pawn and king key agree with the bitboards
+    def Verify(self):
+        for square in chess.SQUARES:
+            expected = chess.BaseBoard.piece_type_at(self, square)
+            if self.mailbox[square] != expected:
+                raise AssertionError(f"Mailbox has {self.mailbox[square]} on {chess.square_name(square)}, bitboards {expected} in {self.fen()}")
+        if self.incrementalSums != ComputeIncrementalSums(self):
+            raise AssertionError(f"Incremental evaluation sums {self.incrementalSums} differ from {ComputeIncrementalSums(self)} in {self.fen()}")
+        if self.pawnKingKey != PawnKingKey(self):
+            raise AssertionError(f"Incremental pawn and king key {self.pawnKingKey:016x} differs from {PawnKingKey(self):016x} in {self.fen()}")
+
+
+# Equivalence with python-chess to the given depth and make/unmake speed: python Position.py [depth]
+# Walks both boards in lockstep and compares the legal moves and the full position after every push and pop.
+def CheckAgainstBoard(position: Position, board: chess.Board, depth):
+    moves = list(board.legal_moves)
+    if set(moves) != set(position.legal_moves):
+        raise AssertionError(f"Legal moves differ in {board.fen()}")
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in moves:
+        board.push(move)
+        position.push(move)
+        if position.fen() != board.fen():
+            raise AssertionError(f"{position.fen()} != {board.fen()} after {move}")
+        position.Verify()
+        nodes += CheckAgainstBoard(position, board, depth - 1)
+        board.pop()
+        position.pop()
+        if position.fen() != board.fen():
+            raise AssertionError(f"{position.fen()} != {board.fen()} after undoing {move}")
+    return nodes
+
+# Microseconds for one push and pop of each legal move, averaged over repetitions
+def MakeUnmakeCost(board, repetitions=1000):
+    moves = list(board.legal_moves)
+    startTime = time.perf_counter()
+    for _ in range(repetitions):
+        for move in moves:
+            board.push(move)
+            board.pop()
+    return (time.perf_counter() - startTime) * 1e6 / (repetitions * len(moves))
+
+checkPositions = [
+    chess.STARTING_FEN,
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+    "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+]
+
+if __name__ == "__main__":
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for fen in checkPositions:
+        nodes = CheckAgainstBoard(Position(chess.Board(fen)), chess.Board(fen), depth - 1)
+        boardCost = MakeUnmakeCost(chess.Board(fen))
+        positionCost = MakeUnmakeCost(Position(chess.Board(fen)))
+        print(f"{fen}: {nodes} leaves match, push+pop chess.Board {boardCost:.2f} us Position {positionCost:.2f} us ({boardCost / positionCost:.2f}x)")
@@ -0,0 +1,40 @@
+import chess
+import cProfile
+import pstats
+import sys
+import threading
+import time
+from Searcher import Searcher
+from LazySMP import benchmarkPositions
+
+# Profiles fixed depth searches of the benchmark positions and shows where the time of one node goes:
+# python Profile.py [depth] [numFunctions]
+# The cost of each function is its own time (without callees) divided by the nodes searched.
+
+def ProfileSearch(depth):
+    searcher = Searcher(chess.Board())
+    searcher.printInfo = False
+    searcher.maxDepth = depth
+    profiler = cProfile.Profile()
+    numNodes = 0
+    startTime = time.perf_counter()
+    for fen in benchmarkPositions:
+        searcher.board = chess.Board(fen)
+        searcher.transpositionTable.Clear()
+        searcher.moveOrderer.Clear()
+        profiler.enable()
+        searcher.StartSearch(threading.Event())
+        profiler.disable()
+        numNodes += searcher.searchDiagnostics.numPositionsEvaluated
+    return profiler, numNodes, time.perf_counter() - startTime
+
+if __name__ == "__main__":
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    numFunctions = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    profiler, numNodes, seconds = ProfileSearch(depth)
+    print(f"depth {depth} nodes {numNodes} time {seconds:.2f}s (profiled) {seconds * 1e6 / numNodes:.1f} us per node")
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:numFunctions]
+    print(f"{'us/node':>9} {'calls/node':>10}  function")
+    for (fileName, line, functionName), (primitiveCalls, numCalls, ownTime, cumulativeTime, callers) in rows:
+        print(f"{ownTime * 1e6 / numNodes:9.2f} {numCalls / numNodes:10.2f}  {functionName} ({fileName.split('/')[-1]}:{line})")
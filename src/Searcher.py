@@ -1,10 +1,15 @@
 import chess
 import chess.polyglot
-from TranspositionTable import TT
-from MoveOrdering import MoveOrdering
+from TranspositionTable import TT, UnpackDepth, UnpackMove
+from Zobrist import KeyStack, PushWithKey
+from Position import Position
+from TimeManager import TimeManager
+from MoveOrdering import MoveOrdering, GetPieceValue, PieceToIndex, GenerateNoisyMoves
+from StaticExchange import SEE
 from Evaluation import Evaluation
 import time
 import os
+import math
 import random
 
 
@@ -27,12 +32,63 @@ class SearchDiagnostics:
         self.isBook = False
 
         self.maxExtentionReachedInSearch = 0
+
+        # Re-searches caused by aspiration windows at the root, and by zero window searches that beat alpha
+        self.numAspirationResearches = 0
+        self.numPvsResearches = 0
+        self.numLmrResearches = 0
+        # Effect of the selective search: cutoffs and pruned moves per technique, and late move reductions applied
+        self.numNullMoveCutoffs = 0
+        self.numReverseFutilityCutoffs = 0
+        self.numFutilityPrunes = 0
+        self.numLateMovePrunes = 0
+        self.numReductions = 0
+        # Beta cutoffs in the main search, and how many of them came from the first move searched
+        self.numSearchCutOffs = 0
+        self.numFirstMoveCutOffs = 0
+        # Quiescence nodes and captures skipped there
+        self.numQNodes = 0
+        self.numDeltaPrunes = 0
+        self.numLosingCapturePrunes = 0
+        # Nodes searched and milliseconds elapsed when each depth was completed (time-to-depth)
+        self.depthNodes = []
+        self.depthTimesMs = []
         
 class Searcher:
-    def __init__(self, board: chess.Board):
+    # With sharedTableName the searcher attaches to that shared transposition table of transpositionTableSizeMB
+    # instead of allocating its own, and skips the warm-up search so nothing is written to the table before a real search
+    def __init__(self, board: chess.Board, transpositionTableSizeMB=64, sharedTableName=None):
         self.board = board
-        self.transpositionTableSizeMB = 64
+        self.transpositionTableSizeMB = transpositionTableSizeMB
         self.maxExtentions = 16
+        self.useAspirationWindows = True
+        self.aspirationMinDepth = 3
+        self.aspirationWindow = 40
+
+        # Selective search. Each technique can be switched off to measure its effect on nodes and depth.
+        self.useNullMovePruning = True
+        self.nullMoveMinDepth = 3
+        self.useReverseFutilityPruning = True
+        self.reverseFutilityMaxDepth = 6
+        self.reverseFutilityMargin = 120
+        self.useFutilityPruning = True
+        self.futilityMargins = [0, 200, 300, 500]
+        self.useLateMovePruning = True
+        # Quiet moves searched at depth d before the rest are pruned
+        self.lateMoveCounts = [0, 4, 7, 12, 19]
+        # Reduce late quiet moves by lmrReductions[depth][moveNumber] (log based) instead of a single ply
+        self.useLogReductions = True
+        self.lmrReductions = [[0] * 64 for _ in range(64)]
+        for depth in range(1, 64):
+            for moveNumber in range(1, 64):
+                self.lmrReductions[depth][moveNumber] = int(0.5 + math.log(depth) * math.log(moveNumber) / 2)
+        # Quiescence search: captures that cannot reach alpha even with this margin are skipped (delta pruning),
+        # and past maxQuiescenceDepth plies the static evaluation is returned
+        self.useDeltaPruning = True
+        self.deltaMargin = 200
+        self.maxQuiescenceDepth = 16
+        # PieceToIndex of the move played at each ply of the current line (-1 for a null move), for continuation history
+        self.movePieceTo = [-1] * 1024
         self.immediateMateScore = 1000000
         self.positiveInfinity = 9999999
         self.negativeInfinity = -self.positiveInfinity
@@ -46,34 +102,88 @@ class Searcher:
         self.searchCancelled = False
         self.searchDiagnostics = SearchDiagnostics()
         self.currentIterationDepth = 0
-        self.transpositionTable = TT(board, self.transpositionTableSizeMB)
+        self.keyStack = KeyStack(board)
+        # The search makes its moves on a Position copied from the board at the start of every search
+        self.position = Position(board)
+        self.transpositionTable = TT(self.transpositionTableSizeMB, sharedTableName is not None, sharedTableName)
         self.moveOrderer = MoveOrdering(self.transpositionTable)
         self.evaluation = Evaluation()
         self.debugInfo = ""
         self.searchIterationTimer = 0
         self.searchTotalTimer = 0
-        self.Search(1, 0, self.negativeInfinity, self.positiveInfinity)
+        self.startDepth = 1
+        self.maxDepth = 256
+        self.maxNodes = 0
+        self.mateInMoves = 0
+        self.printInfo = True
+        self.timeManager = TimeManager()
+        # The clock and the stop signal are polled once every timeCheckInterval nodes
+        self.timeCheckInterval = 32
+        # Shared flag (anything with a .value) that another process sets to cancel this search
+        self.stopSignal = None
+        # Called with (depth, move, eval) after every completed iteration
+        self.iterationCallback = None
+        if sharedTableName is None:
+            self.keyStack.Attach(self.position)
+            self.Search(1, 0, self.negativeInfinity, self.positiveInfinity)
+            self.keyStack.Attach(board)
 
     
     def UCIInfo(self, depth, score, nodes, time_ms):
-        info_str = f"info depth {depth} score {int(score)} nodes {nodes} time {time_ms} nps {nodes*1000//(time_ms if time_ms != 0 else 1000)} pv {self.bestMove.uci()}"
+        if not self.printInfo:
+            return
+        time_ms = max(time_ms, 1)
+        info_str = f"info depth {depth} score {int(score)} nodes {nodes} time {time_ms} nps {nodes*1000//time_ms} hashfull {self.transpositionTable.HashFull()} pv {self.bestMove.uci()}"
         print(info_str)
     
-    def StartSearch(self, event):
+    def SetDebugMode(self, enabled):
+        # In debug mode every incrementally updated key and evaluation sum is cross-checked against a full recomputation
+        self.keyStack.debug = enabled
+        self.evaluation.verifyIncremental = enabled
+
+    def MakeMove(self, move: chess.Move):
+        self.keyStack.Push(move)
+        if self.keyStack.debug and self.keyStack.board is self.position:
+            self.position.Verify()
+
+    def UndoMove(self):
+        self.keyStack.Pop()
+
+    # A limit of 0 means no limit; the time limits belong to the time manager
+    def SetSearchLimits(self, maxDepth=256, maxNodes=0, mateInMoves=0):
+        self.maxDepth = maxDepth
+        self.maxNodes = maxNodes
+        self.mateInMoves = mateInMoves
+
+    def StartSearch(self, event, generation=None):
         self.bestEvalThisIteration = self.bestEval = 0
         self.bestMoveThisIteration = self.bestMove = chess.Move.null()
 
         self.isPlayingWhite = self.board.turn == chess.WHITE
+        self.keyStack.Reset(self.board)
+        self.position.SetFromBoard(self.board)
+        self.keyStack.Attach(self.position)
+        self.transpositionTable.NewSearch(generation)
 
-        self.moveOrderer.ClearHistory()
+        self.moveOrderer.AgeHistory()
+        self.moveOrderer.numNodesPicked = self.moveOrderer.numMovesScored = 0
+        self.evaluation.pawnHash.ResetCounters()
+        self.evaluation.evalCache.ResetCounters()
 
         
         # Debug
         self.CurrentDepth = 0
-        self.searchCancelled = False
+        # searchCancelled is cleared when the previous search ends, not here:
+        # a stop that arrives before the search thread reaches this point must still be honoured
         self.searchDiagnostics = SearchDiagnostics()
+        self.searchTotalTimer = time.time()
         
         self.RunIterativeDeepeningSearch()
+        self.keyStack.Attach(self.board)
+        if self.keyStack.debug:
+            self.PrintDiagnostics()
+        elif self.printInfo:
+            self.PrintCacheStatistics()
         
         if self.bestMove == chess.Move.null():
             self.bestMove = random.choice(list(self.board.legal_moves))
@@ -85,13 +195,13 @@ class Searcher:
         return self.immediateMateScore - abs(eval)
         
     def RunIterativeDeepeningSearch(self):
-        for searchDepth in range(1, 257):
+        for searchDepth in range(self.startDepth, self.maxDepth + 1):
             self.hasSearchedAtLeastOneMove = False
             self.debugInfo += "\nStarting Iteration: " + str(searchDepth)
             self.searchIterationTimer = time.time()
             self.currentIterationDepth = searchDepth
             #print("<<<< Searching on Depth", searchDepth, "Starting >>>>")
-            self.Search(searchDepth, 0, self.negativeInfinity, self.positiveInfinity)
+            self.AspirationSearch(searchDepth)
             
             if self.searchCancelled:
                 if self.hasSearchedAtLeastOneMove:
@@ -119,18 +229,87 @@ class Searcher:
                 self.searchDiagnostics.move = self.bestMove
                 self.searchDiagnostics.eval = self.bestEval
                 
-                elapsed_time_ms = int((time.time() - self.searchIterationTimer) * 1000)
+                elapsed_time_ms = int((time.time() - self.searchTotalTimer) * 1000)
+                self.searchDiagnostics.depthNodes.append(self.searchDiagnostics.numPositionsEvaluated)
+                self.searchDiagnostics.depthTimesMs.append(elapsed_time_ms)
                 self.UCIInfo(searchDepth, self.bestEval, self.searchDiagnostics.numPositionsEvaluated, elapsed_time_ms)
+                if self.iterationCallback is not None:
+                    self.iterationCallback(searchDepth, self.bestMove, self.bestEval)
                 
                 if IsMateScore(self.bestEval) and self.NumPlyToMateFromScore(self.bestEval) <= searchDepth:
                     self.debugInfo += "\nExitting search due to mate found within search depth"
                     #self.searchCancelled = True
                     break
+
+                if self.mateInMoves and IsMateScore(self.bestEval) and self.bestEval > 0 and (self.NumPlyToMateFromScore(self.bestEval) + 1) // 2 <= self.mateInMoves:
+                    self.debugInfo += "\nExitting search due to requested mate found"
+                    break
+
+                if self.timeManager.ShouldStopAfterIteration(self.bestMove, self.bestEval):
+                    self.debugInfo += "\nExitting search due to time"
+                    break
             
 
                 
+    # Searches the root with a narrow window around the previous iteration's score.
+    # A result outside the window only proves a bound, so the window is widened on that side and the depth searched again.
+    def AspirationSearch(self, searchDepth):
+        if not self.useAspirationWindows or searchDepth < self.aspirationMinDepth or IsMateScore(self.bestEval):
+            return self.Search(searchDepth, 0, self.negativeInfinity, self.positiveInfinity)
+
+        window = self.aspirationWindow
+        alpha = self.bestEval - window
+        beta = self.bestEval + window
+        while True:
+            eval = self.Search(searchDepth, 0, alpha, beta)
+            if self.searchCancelled or alpha < eval < beta:
+                return eval
+
+            self.searchDiagnostics.numAspirationResearches += 1
+            window *= 2
+            if eval <= alpha:
+                alpha = eval - window
+            else:
+                beta = eval + window
+            if window > 1000 or IsMateScore(eval):
+                alpha, beta = self.negativeInfinity, self.positiveInfinity
+
+    def PrintDiagnostics(self):
+        diagnostics = self.searchDiagnostics
+        timeToDepth = " ".join(f"{depth}:{nodes}/{ms}" for depth, nodes, ms in zip(range(self.startDepth, self.startDepth + len(diagnostics.depthNodes)), diagnostics.depthNodes, diagnostics.depthTimesMs))
+        print(f"info string nodes {diagnostics.numPositionsEvaluated} cutoffs {diagnostics.numCutOffs} researches aspiration {diagnostics.numAspirationResearches} pvs {diagnostics.numPvsResearches} lmr {diagnostics.numLmrResearches}")
+        print(f"info string pruning nullmove {diagnostics.numNullMoveCutoffs} reversefutility {diagnostics.numReverseFutilityCutoffs} futility {diagnostics.numFutilityPrunes} latemove {diagnostics.numLateMovePrunes} reductions {diagnostics.numReductions}")
+        print(f"info string ordering moves scored per node {self.moveOrderer.numMovesScored / max(1, self.moveOrderer.numNodesPicked):.1f} cutoffs {diagnostics.numSearchCutOffs} on first move {100 * diagnostics.numFirstMoveCutOffs / max(1, diagnostics.numSearchCutOffs):.1f}%")
+        print(f"info string qsearch nodes {diagnostics.numQNodes} delta {diagnostics.numDeltaPrunes} losingcaptures {diagnostics.numLosingCapturePrunes} mates {diagnostics.numQMates}")
+        self.PrintCacheStatistics()
+        print(f"info string depth:nodes/ms {timeToDepth}")
+
+    def PrintCacheStatistics(self):
+        evalCache = self.evaluation.evalCache
+        pawnHash = self.evaluation.pawnHash
+        print(f"info string evalcache {evalCache.sizeMB}MB hits {evalCache.numHits} misses {evalCache.numMisses} hitrate {100 * evalCache.HitRate():.1f}%")
+        print(f"info string pawnhash entries {pawnHash.numEntries} hits {pawnHash.numHits} misses {pawnHash.numMisses} hitrate {100 * pawnHash.HitRate():.1f}%")
+
+    def CheckStopConditions(self):
+        if self.timeManager.HardLimitReached() or (self.stopSignal is not None and self.stopSignal.value):
+            self.searchCancelled = True
+        elif self.maxNodes and self.searchDiagnostics.numPositionsEvaluated >= self.maxNodes:
+            self.searchCancelled = True
+
     def GetSearchResult(self):
         return (self.bestMove, self.bestEval)
+
+    # The reply we expect to the given move: the stored best move of the position after it
+    def GetPonderMove(self, move: chess.Move):
+        if not move or not self.board.is_legal(move):
+            return chess.Move.null()
+        # Work on a copy: the bot's board may be read by the UCI thread meanwhile
+        board = self.board.copy(stack=False)
+        key = PushWithKey(board, self.keyStack.Current(), move)
+        ponderMove = self.transpositionTable.TryGetStoredMove(key)
+        if ponderMove and not board.is_legal(ponderMove):
+            ponderMove = chess.Move.null()
+        return ponderMove
     
     def EndSearch(self):
         self.searchCancelled = True
@@ -138,11 +317,17 @@ class Searcher:
     def Search(self, plyRemaining, plyFromRoot, alpha, beta, numExtensions = 0, prevMove: chess.Move = chess.Move.null(), prevWasCapture = False):
         
         self.searchDiagnostics.numPositionsEvaluated += 1
+        if self.searchDiagnostics.numPositionsEvaluated % self.timeCheckInterval == 0:
+            self.CheckStopConditions()
         if self.searchCancelled:
             return 0
         
+        key = self.keyStack.Current()
         if plyFromRoot > 0:
-            if self.board.is_repetition():
+            if self.keyStack.IsRepetition():
+                return 0
+            # Fifty-move rule, unless this very move delivered mate
+            if self.position.halfmove_clock >= 100 and not (self.position.is_check() and not any(self.position.generate_legal_moves())):
                 return 0
 
             alpha = max(alpha, -self.immediateMateScore + plyFromRoot)
@@ -150,75 +335,127 @@ class Searcher:
             if alpha >= beta:
                 return alpha
 
-        ttVal = self.transpositionTable.LookupEvaluation(plyRemaining, plyFromRoot, alpha, beta)
-        if ttVal != LookupFailed:
-            if plyFromRoot == 0:
-                self.bestMoveThisIteration = self.transpositionTable.TryGetStoredMove()
-                self.bestEvalThisIteration = self.transpositionTable.entries[self.transpositionTable.Index()].value
-            return ttVal
-        
-        if plyRemaining == 0:
-            return self.QuiescenceSearch(alpha, beta)
+            # The root is always searched, so that every iteration produces a move and an exact score
+            ttVal = self.transpositionTable.LookupEvaluation(key, plyRemaining, plyFromRoot, alpha, beta)
+            if ttVal != LookupFailed:
+                return ttVal
         
-        moves = list(self.board.legal_moves)
-        prevBestMove = self.bestMove if plyFromRoot == 0 else self.transpositionTable.TryGetStoredMove()
-        self.moveOrderer.OrderMoves(prevBestMove, self.board, moves, False, plyFromRoot)
-        if self.board.is_checkmate():
-            mateScore = self.immediateMateScore - plyFromRoot
-            return -mateScore
-        
-        if self.board.is_stalemate():
-            return 0
+        if plyRemaining <= 0:
+            return self.QuiescenceSearch(alpha, beta, plyFromRoot)
+
+        inCheck = self.position.is_check()
+        isPvNode = beta - alpha > 1
+        # Forward pruning is only done where it cannot lose the principal variation or a forced mate
+        canPrune = plyFromRoot > 0 and not isPvNode and not inCheck and not IsMateScore(alpha) and not IsMateScore(beta)
+        staticEval = self.evaluation.Evaluate(self.position, self.keyStack.Current()) if canPrune else 0
+
+        if canPrune:
+            # Reverse futility: the static evaluation beats beta by more than the opponent could recover in the remaining plies
+            if self.useReverseFutilityPruning and plyRemaining <= self.reverseFutilityMaxDepth and staticEval - self.reverseFutilityMargin * plyRemaining >= beta:
+                self.searchDiagnostics.numReverseFutilityCutoffs += 1
+                return beta
+
+            # Null move: if passing still fails high on a reduced search, a real move would too.
+            # Not after another null move, and not without pieces, where zugzwang makes passing an advantage.
+            if self.useNullMovePruning and plyRemaining >= self.nullMoveMinDepth and prevMove and staticEval >= beta and self.HasNonPawnMaterial():
+                reduceDepth = 3 if plyRemaining >= 6 else 2
+                self.movePieceTo[plyFromRoot] = -1
+                self.MakeMove(chess.Move.null())
+                eval = -self.Search(plyRemaining - 1 - reduceDepth, plyFromRoot + 1, -beta, -beta + 1, numExtensions, chess.Move.null(), False)
+                self.UndoMove()
+                if self.searchCancelled:
+                    return 0
+                if eval >= beta:
+                    self.searchDiagnostics.numNullMoveCutoffs += 1
+                    return beta
         
-        if plyFromRoot > 0:
-            wasPawnMove = self.board.piece_type_at(prevMove.from_square) == chess.PAWN
+        prevBestMove = (self.bestMoveThisIteration or self.bestMove) if plyFromRoot == 0 else self.transpositionTable.TryGetStoredMove(key)
         
         evaluationBound = UpperBound
-        self.bestMoveInThisPosition = chess.Move.null()
+        bestMoveInThisPosition = chess.Move.null()
         
-        for i, move in enumerate(moves):
-            capturedPieceType = self.board.piece_type_at(move.to_square) if self.board.is_capture(move) else None
+        continuationIndices = (self.movePieceTo[plyFromRoot - 1] if plyFromRoot >= 1 else -1, self.movePieceTo[plyFromRoot - 2] if plyFromRoot >= 2 else -1)
+        quietsSearched = []
+        i = -1
+        for i, move in enumerate(self.moveOrderer.PickMoves(prevBestMove, self.position, plyFromRoot, prevMove, continuationIndices)):
+            capturedPieceType = self.position.piece_type_at(move.to_square) if self.position.is_capture(move) else None
             isCapture = capturedPieceType != None
-            self.board.push(move)
+            isQuiet = not isCapture and move.promotion is None
+            # The exchange is only needed for captures late enough in the ordering to be reduced
+            isLosingCapture = isCapture and i >= 3 and plyRemaining >= 3 and not inCheck and SEE(self.position, move) < 0
+            self.movePieceTo[plyFromRoot] = PieceToIndex(self.position.turn, self.position.piece_type_at(move.from_square), move.to_square)
+            self.MakeMove(move)
+            givesCheck = self.position.is_check()
             extension = 0
             if numExtensions < self.maxExtentions:
-                movedPieceType = self.board.piece_type_at(move.to_square)
+                movedPieceType = self.position.piece_type_at(move.to_square)
                 targetRank = chess.square_rank(move.to_square)
-                if self.board.is_check():
+                if givesCheck:
                     extension = 1
                 elif (movedPieceType == chess.PAWN and (targetRank == 1 or targetRank == 6)):
                     extension = 1
-                    
-            needsFullSearch = True
-            eval = 0
-            
-            if(extension == 0 and plyRemaining >= 3 and i >= 3 and not isCapture):
-                reduceDepth = 1
-                eval = -self.Search(plyRemaining - 1 -reduceDepth, plyFromRoot + 1, -alpha - 1, -alpha, numExtensions, move, isCapture)
-                needsFullSearch = eval > alpha
-                
-            if (needsFullSearch):
+
+            if canPrune and i > 0 and isQuiet and not givesCheck:
+                # Late move pruning: at low depth, quiet moves this far down the ordering practically never raise alpha
+                if self.useLateMovePruning and plyRemaining < len(self.lateMoveCounts) and i >= self.lateMoveCounts[plyRemaining]:
+                    self.UndoMove()
+                    self.searchDiagnostics.numLateMovePrunes += 1
+                    continue
+                # Futility pruning: a quiet move cannot lift a static evaluation this far below alpha
+                if self.useFutilityPruning and plyRemaining < len(self.futilityMargins) and staticEval + self.futilityMargins[plyRemaining] <= alpha:
+                    self.UndoMove()
+                    self.searchDiagnostics.numFutilityPrunes += 1
+                    continue
+
+            # Principal variation search: only the first move gets the full window.
+            # The others are expected to be worse and get a zero window search (reduced for late quiet moves),
+            # which is repeated at full depth and then with the full window only when it beats alpha.
+            if i == 0:
                 eval = -self.Search(plyRemaining - 1 + extension, plyFromRoot + 1, -beta, -alpha, numExtensions + extension, move, isCapture)
+            else:
+                reduceDepth = 0
+                # Late quiet moves and captures that lose material in the exchange are searched with reduced depth
+                if extension == 0 and plyRemaining >= 3 and i >= 3 and (not isCapture or isLosingCapture) and not inCheck:
+                    reduceDepth = 1
+                    if self.useLogReductions:
+                        reduceDepth = self.lmrReductions[min(plyRemaining, 63)][min(i, 63)] - (1 if isPvNode else 0)
+                        reduceDepth = max(1, min(reduceDepth, plyRemaining - 2))
+                    self.searchDiagnostics.numReductions += 1
+                eval = -self.Search(plyRemaining - 1 + extension - reduceDepth, plyFromRoot + 1, -alpha - 1, -alpha, numExtensions + extension, move, isCapture)
+                if eval > alpha and reduceDepth:
+                    self.searchDiagnostics.numLmrResearches += 1
+                    eval = -self.Search(plyRemaining - 1 + extension, plyFromRoot + 1, -alpha - 1, -alpha, numExtensions + extension, move, isCapture)
+                if alpha < eval < beta:
+                    self.searchDiagnostics.numPvsResearches += 1
+                    eval = -self.Search(plyRemaining - 1 + extension, plyFromRoot + 1, -beta, -alpha, numExtensions + extension, move, isCapture)
 
-            self.board.pop()
+            self.UndoMove()
             
             if (self.searchCancelled):
                 return 0
             
             if eval >= beta:
-                self.transpositionTable.StoreEvaluation(plyRemaining, plyFromRoot, beta, LowerBound, move)
-                if not isCapture:
-                    if plyFromRoot < self.moveOrderer.maxKillerMovePly:
-                        self.moveOrderer.killerMoves[plyFromRoot].Add(move)
-                    historyScore = plyRemaining * plyRemaining
-                    self.moveOrderer.History[self.board.turn][move.from_square][move.to_square] += historyScore
+                self.transpositionTable.StoreEvaluation(key, plyRemaining, plyFromRoot, beta, LowerBound, move)
+                if plyFromRoot == 0:
+                    # Fail high of an aspiration window: remember the move that refuted it
+                    self.bestMoveThisIteration = move
+                    self.bestEvalThisIteration = eval
+                    self.hasSearchedAtLeastOneMove = True
+                if isQuiet:
+                    self.moveOrderer.UpdateQuietStats(self.position, move, plyRemaining, plyFromRoot, quietsSearched, prevMove, continuationIndices)
                 
                 self.searchDiagnostics.numCutOffs += 1
+                self.searchDiagnostics.numSearchCutOffs += 1
+                if i == 0:
+                    self.searchDiagnostics.numFirstMoveCutOffs += 1
                 return beta
             
+            if isQuiet:
+                quietsSearched.append(move)
+            
             if eval > alpha:
                 evaluationBound = Exact
-                self.bestMoveInThisPosition = move
+                bestMoveInThisPosition = move
                 alpha = eval
                 
                 if plyFromRoot == 0:
@@ -226,42 +463,93 @@ class Searcher:
                     self.bestEvalThisIteration = eval
                     self.hasSearchedAtLeastOneMove = True
         
+        # No legal move: checkmate or stalemate
+        if i < 0:
+            return -(self.immediateMateScore - plyFromRoot) if inCheck else 0
         
-        self.transpositionTable.StoreEvaluation(plyRemaining, plyFromRoot, alpha, evaluationBound, self.bestMoveInThisPosition)
+        self.transpositionTable.StoreEvaluation(key, plyRemaining, plyFromRoot, alpha, evaluationBound, bestMoveInThisPosition)
         return alpha
     
-    def QuiescenceSearch(self, alpha, beta):
+    def HasNonPawnMaterial(self):
+        board = self.position
+        return board.occupied_co[board.turn] & ~(board.pawns | board.kings) != 0
+
+    # Captures (and queen promotions) only, until the position is quiet. In check every evasion is searched instead,
+    # since standing pat is not an option there. Entries are stored at depth 0, which is what a depth 0 search means,
+    # and only when the table holds no deeper result for the position: that one (and its move) is worth more.
+    def QuiescenceSearch(self, alpha, beta, plyFromRoot=0, qDepth=0):
+        self.searchDiagnostics.numPositionsEvaluated += 1
+        self.searchDiagnostics.numQNodes += 1
+        if self.searchDiagnostics.numPositionsEvaluated % self.timeCheckInterval == 0:
+            self.CheckStopConditions()
         if self.searchCancelled:
             return 0
 
-        eval = self.evaluation.Evaluate(self.board)
-        self.searchDiagnostics.numPositionsEvaluated += 1
-        if eval >= beta:
-            self.searchDiagnostics.numCutOffs += 1
-            return beta
-        if eval > alpha:
-            alpha = eval
-        
-        moves = []       
-        for mv in list(self.board.legal_moves):
-            if self.board.is_capture(mv) or mv.promotion not in [None, chess.KNIGHT]:
-                moves.append(mv)
-        
-        self.moveOrderer.OrderMoves(chess.Move.null(), self.board, moves, True, 0)
-        for i, move in enumerate(moves):
-            self.board.push(move)
-           
-            eval = -self.QuiescenceSearch(-beta, -alpha)
-            self.board.pop()
-            
+        key = self.keyStack.Current()
+        ttVal = self.transpositionTable.LookupEvaluation(key, 0, plyFromRoot, alpha, beta)
+        if ttVal != LookupFailed:
+            return ttVal
+
+        ttIndex, ttData = self.transpositionTable.Probe(key)
+        hasDeeperEntry = ttIndex >= 0 and UnpackDepth(ttData) > 0
+        ttMove = UnpackMove(ttData) if ttIndex >= 0 else chess.Move.null()
+
+        originalAlpha = alpha
+        inCheck = self.position.is_check()
+        if inCheck:
+            moves = list(self.position.legal_moves)
+            if not moves:
+                self.searchDiagnostics.numQMates += 1
+                return -(self.immediateMateScore - plyFromRoot)
+            standPat = -INF
+        else:
+            standPat = self.evaluation.Evaluate(self.position, self.keyStack.Current())
+            if standPat >= beta:
+                self.searchDiagnostics.numCutOffs += 1
+                return beta
+            if standPat > alpha:
+                alpha = standPat
+            if qDepth >= self.maxQuiescenceDepth:
+                return alpha
+            moves = self.GenerateQuiescenceMoves()
+
+        losingCaptures = self.moveOrderer.OrderMoves(ttMove, self.position, moves, True, plyFromRoot)
+        bestMove = chess.Move.null()
+        for move in moves:
+            if not inCheck and move.promotion is None:
+                capturedPieceType = self.position.piece_type_at(move.to_square) or chess.PAWN
+                # Delta pruning: even winning the captured piece for free cannot bring the score up to alpha
+                if self.useDeltaPruning and standPat + GetPieceValue(capturedPieceType) + self.deltaMargin <= alpha:
+                    self.searchDiagnostics.numDeltaPrunes += 1
+                    continue
+                # Losing captures do not lift the score above the stand pat. The ordering ran the exchange for all but the hash move.
+                if (SEE(self.position, move) < 0 if move == ttMove else move in losingCaptures):
+                    self.searchDiagnostics.numLosingCapturePrunes += 1
+                    continue
+
+            self.MakeMove(move)
+            eval = -self.QuiescenceSearch(-beta, -alpha, plyFromRoot + 1, qDepth + 1)
+            self.UndoMove()
+            if self.searchCancelled:
+                return 0
+
             if eval >= beta:
+                if not hasDeeperEntry:
+                    self.transpositionTable.StoreEvaluation(key, 0, plyFromRoot, beta, LowerBound, move)
                 self.searchDiagnostics.numCutOffs += 1
                 return beta
-            
             if eval > alpha:
                 alpha = eval
+                bestMove = move
+
+        if not hasDeeperEntry:
+            self.transpositionTable.StoreEvaluation(key, 0, plyFromRoot, alpha, Exact if alpha > originalAlpha else UpperBound, bestMove)
         return alpha
 
+    # Legal captures (including en passant) and queen promotions. Under-promotions are left to the main search.
+    def GenerateQuiescenceMoves(self):
+        return [move for move in GenerateNoisyMoves(self.position) if move.promotion is None or move.promotion == chess.QUEEN]
+
     def AnnounceMate(self):
         if IsMateScore(self.bestEvalThisIteration):
             numPlyToMate = self.NumPlyToMateFromScore(self.bestEvalThisIteration)
@@ -271,9 +559,26 @@ class Searcher:
             return f"{sideWithMate} can mate in {numMovesToMate} move{p}"
         return "No mate found"
     
+    def SetTranspositionTableSize(self, sizeMB, sharedName=None):
+        self.transpositionTableSizeMB = sizeMB
+        self.transpositionTable.Resize(sizeMB, sharedName)
+
+    def SetEvalCacheSize(self, sizeMB):
+        self.evaluation.evalCache.Resize(sizeMB)
+
+    # Entries of the pawn and king structure cache, rounded down to a power of two
+    def SetPawnHashSize(self, numEntries):
+        self.evaluation.pawnHash.Resize(numEntries)
+
+    # Searchers in several processes can work on one table: the first one creates it (sharedName=None)
+    # and the others attach with its SharedName() and the same size
+    def UseSharedTranspositionTable(self, sharedName=None):
+        self.transpositionTable.SetShared(True, sharedName)
+
+    # Entries from the previous game are aged out by the replacement policy rather than wiped
     def ClearForNewPosition(self):
-        self.transpositionTable.Clear()
-        self.moveOrderer.ClearKillers()
+        self.transpositionTable.NewSearch()
+        self.moveOrderer.Clear()
     
     def GetTranspositionTable(self):
         return self.transpositionTable
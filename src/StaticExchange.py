@@ -0,0 +1,96 @@
+import chess
+import sys
+import time
+from PSQT import pieceValues
+
+# Static exchange evaluation: the material balance of the capture sequence on one square when both sides always
+# recapture with their least valuable attacker and may stop whenever continuing would lose material.
+# Works on python-chess' integer bitboards. Removing each capturer from the occupancy uncovers the sliders
+# behind it (x-rays), so batteries of rooks, queens and bishops are counted. Pins are ignored.
+
+seeValues = [0] * 7
+for pieceType in chess.PIECE_TYPES:
+    seeValues[pieceType] = pieceValues[pieceType]
+
+# Every piece of either color attacking the square, given an occupancy that may differ from the board's
+def AttackersTo(board: chess.Board, square, occupied):
+    queensAndRooks = board.queens | board.rooks
+    queensAndBishops = board.queens | board.bishops
+    return ((chess.BB_KING_ATTACKS[square] & board.kings) |
+            (chess.BB_KNIGHT_ATTACKS[square] & board.knights) |
+            (chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied] & queensAndRooks) |
+            (chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied] & queensAndRooks) |
+            (chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied] & queensAndBishops) |
+            (chess.BB_PAWN_ATTACKS[chess.BLACK][square] & board.pawns & board.occupied_co[chess.WHITE]) |
+            (chess.BB_PAWN_ATTACKS[chess.WHITE][square] & board.pawns & board.occupied_co[chess.BLACK]))
+
+# Material won (positive) or lost (negative) by the side to move when playing the move and the exchange that follows
+def SEE(board: chess.Board, move: chess.Move):
+    fromSq = move.from_square
+    toSq = move.to_square
+    occupied = board.occupied
+    movedPieceType = board.piece_type_at(fromSq)
+    if movedPieceType == chess.KING and board.occupied_co[board.turn] & chess.BB_SQUARES[toSq]:
+        return 0  # Castling
+
+    capturedPieceType = board.piece_type_at(toSq)
+    if capturedPieceType is None and movedPieceType == chess.PAWN and toSq == board.ep_square:
+        capturedPieceType = chess.PAWN
+        occupied ^= chess.BB_SQUARES[toSq - 8 if board.turn == chess.WHITE else toSq + 8]
+
+    gain = [seeValues[capturedPieceType or 0]]
+    pieceOnSquare = movedPieceType
+    if move.promotion:
+        gain[0] += seeValues[move.promotion] - seeValues[chess.PAWN]
+        pieceOnSquare = move.promotion
+
+    occupied ^= chess.BB_SQUARES[fromSq]
+    attackers = AttackersTo(board, toSq, occupied) & occupied
+    color = not board.turn
+    while True:
+        colorAttackers = attackers & board.occupied_co[color]
+        if not colorAttackers:
+            break
+        for attackerType in chess.PIECE_TYPES:
+            attackerSquares = colorAttackers & board.pieces_mask(attackerType, color)
+            if attackerSquares:
+                break
+        # The king may only take last
+        if attackerType == chess.KING and attackers & board.occupied_co[not color]:
+            break
+
+        gain.append(seeValues[pieceOnSquare] - gain[-1])
+        pieceOnSquare = attackerType
+        occupied ^= attackerSquares & -attackerSquares
+        # Sliders behind the piece that just captured now see the square
+        attackers = AttackersTo(board, toSq, occupied) & occupied
+        color = not color
+
+    # Each side may stand pat instead of recapturing: fold the swap list back to the first capture
+    for i in range(len(gain) - 1, 0, -1):
+        gain[i - 1] = -max(-gain[i - 1], gain[i])
+    return gain[0]
+
+
+# Micro-benchmark: python StaticExchange.py [iterations]
+benchmarkPositions = [
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 1",
+    "1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1",
+    "r1b1k2r/ppp2ppp/2n5/3qp3/1b1P4/2N2N2/PP2BPPP/R2QK2R b KQkq - 0 1",
+]
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    cases = []
+    for fen in benchmarkPositions:
+        board = chess.Board(fen)
+        cases.extend((board, move) for move in board.generate_legal_captures())
+
+    startTime = time.perf_counter()
+    for _ in range(iterations):
+        for board, move in cases:
+            SEE(board, move)
+    seconds = time.perf_counter() - startTime
+    numCalls = iterations * len(cases)
+    print(f"SEE: {numCalls} calls over {len(cases)} captures, {seconds * 1e6 / numCalls:.2f} us per call")
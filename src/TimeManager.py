@@ -0,0 +1,90 @@
+import time
+from constants import *
+
+# Decides how long a search may run.
+# The soft limit is the normal budget, checked between iterations: it shrinks while the best move stays the same
+# and grows when the score drops. The hard limit is never exceeded and is polled from inside the search.
+class TimeManager:
+    def __init__(self):
+        self.moveOverheadMs = 30
+        self.minimumThinkTimeMs = 10
+        self.defaultMovesToGo = 40
+        self.hardLimitMultiplier = 4
+        self.scoreDropMargin = 30
+        # Share of the soft limit after which no new iteration is started: the next one usually takes longer than all before it
+        self.iterationStartShare = 0.55
+        self.minBranchingFactor = 1.5
+        self.maxBranchingFactor = 4
+        self.startTime = time.perf_counter()
+        self.softLimitMs = INF
+        self.hardLimitMs = INF
+        self.adaptive = False
+        self.stableIterations = 0
+        self.previousBestMove = None
+        self.previousScore = None
+        self.iterationEndTimesMs = []
+
+    # Returns (softLimitMs, hardLimitMs) for the side to move
+    def AllocateFromClock(self, timeRemainingMs, incrementMs, movesToGo=0):
+        available = max(self.minimumThinkTimeMs, timeRemainingMs - self.moveOverheadMs)
+        movesToGo = movesToGo if movesToGo > 0 else self.defaultMovesToGo
+        softLimitMs = available / movesToGo + incrementMs * 0.75
+        # Never plan to use more than half of the clock on one move, except on the last move before the time control
+        maxShare = 0.9 if movesToGo == 1 else 0.5
+        softLimitMs = min(softLimitMs, available * maxShare)
+        hardLimitMs = min(softLimitMs * self.hardLimitMultiplier, available * (0.9 if movesToGo == 1 else 0.75))
+        return max(self.minimumThinkTimeMs, softLimitMs), max(self.minimumThinkTimeMs, hardLimitMs)
+
+    # adaptive enables the early stop / extension heuristics; a fixed 'movetime' search uses its whole budget
+    def Start(self, softLimitMs=INF, hardLimitMs=INF, adaptive=False):
+        self.startTime = time.perf_counter()
+        self.softLimitMs = softLimitMs
+        self.hardLimitMs = hardLimitMs
+        self.adaptive = adaptive
+        self.stableIterations = 0
+        self.previousBestMove = None
+        self.previousScore = None
+        self.iterationEndTimesMs = []
+
+    def StartMoveTime(self, moveTimeMs):
+        limitMs = max(self.minimumThinkTimeMs, moveTimeMs - self.moveOverheadMs)
+        self.Start(limitMs, limitMs)
+
+    def ElapsedMs(self):
+        return (time.perf_counter() - self.startTime) * 1000
+
+    def HardLimitReached(self):
+        return self.ElapsedMs() >= self.hardLimitMs
+
+    # Time the next iteration will take, from the growth between the last two completed iterations
+    def PredictNextIterationMs(self):
+        times = self.iterationEndTimesMs
+        if len(times) < 3:
+            return 0
+        lastMs = times[-1] - times[-2]
+        previousMs = max(1, times[-2] - times[-3])
+        return lastMs * min(self.maxBranchingFactor, max(self.minBranchingFactor, lastMs / previousMs))
+
+    # Called after every completed iteration
+    def ShouldStopAfterIteration(self, bestMove, score):
+        elapsedMs = self.ElapsedMs()
+        self.iterationEndTimesMs.append(elapsedMs)
+        if bestMove == self.previousBestMove:
+            self.stableIterations += 1
+        else:
+            self.stableIterations = 0
+
+        scale = 1
+        if self.adaptive:
+            # A best move that survives several iterations is unlikely to change: stop early
+            scale *= max(0.5, 1.2 - 0.15 * self.stableIterations)
+            # A falling score means trouble: think longer to find a better move
+            if self.previousScore is not None and score < self.previousScore - self.scoreDropMargin:
+                scale *= 2 if score < self.previousScore - 3 * self.scoreDropMargin else 1.5
+
+        self.previousBestMove = bestMove
+        self.previousScore = score
+        if not self.adaptive:
+            return elapsedMs >= min(self.softLimitMs, self.hardLimitMs)
+        # Do not start an iteration that would run past the soft limit, or one that the hard limit would cut off
+        return elapsedMs >= self.softLimitMs * scale * self.iterationStartShare or elapsedMs + self.PredictNextIterationMs() >= self.hardLimitMs
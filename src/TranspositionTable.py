@@ -1,85 +1,247 @@
 import chess
-import sys
-import chess.polyglot
+from array import array
+from multiprocessing import shared_memory
 from Helpers import *
 from constants import *
 
-class Entry:
-    def __init__(self, key, value, depth, flag, move: chess.Move):
-        self.key = key
-        self.value = value
-        self.depth = depth
-        self.nodeType = flag
-        self.move = move
-        
-    def getSize():
-        try:
-            return sys.getsizeof(Entry)
-        except:
-            return 0
+# Every entry is stored as two unsigned 64-bit words kept in flat arrays:
+#   keys[i] -> zobrist key of the position xor data[i]
+#   data[i] -> packed score | generation | depth | bound | move
+# This keeps the table footprint at 16 bytes per entry, so the configured size in MB is the real size.
+# Entries are grouped in buckets of consecutive slots that share one index.
+# Storing the key xor'ed with the data makes entries lockless: when several processes share the table,
+# a torn write (key from one store, data from another) no longer matches any key and reads as a miss.
+ttEntrySizeBytes = 16
+bucketSize = 4
+
+moveBits = 16
+boundShift = 16
+depthShift = 18
+generationShift = 26
+scoreShift = 32
+boundMask = 0x3
+depthMask = 0xFF
+generationMask = 0x3F
+moveMask = 0xFFFF
+scoreOffset = 1 << 31
+maxStoredDepth = depthMask
+
+
+def EncodeMove(move: chess.Move):
+    if not move:
+        return 0
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def DecodeMove(encoded):
+    if encoded == 0:
+        return chess.Move.null()
+    promotion = (encoded >> 12) & 0x7
+    return chess.Move(encoded & 0x3F, (encoded >> 6) & 0x3F, promotion if promotion else None)
+
+def PackData(score, depth, bound, encodedMove, generation=0):
+    return ((int(score) + scoreOffset) << scoreShift) | (generation << generationShift) | (min(depth, maxStoredDepth) << depthShift) | (bound << boundShift) | encodedMove
+
+def UnpackScore(data):
+    return (data >> scoreShift) - scoreOffset
+
+def UnpackDepth(data):
+    return (data >> depthShift) & depthMask
+
+def UnpackGeneration(data):
+    return (data >> generationShift) & generationMask
+
+def UnpackBound(data):
+    return (data >> boundShift) & boundMask
+
+def UnpackMove(data):
+    return DecodeMove(data & moveMask)
+
 
 class TT:
-    
-    def __init__(self, board: chess.Board, sizeMB):
-        self.board = board
-        ttEntrySizeBytes = sys.getsizeof(Entry)
-        self.count  = int(sizeMB * 1024 * 1024 / ttEntrySizeBytes)
-        self.entries = [Entry(0, 0, 0, 0, chess.Move.null()) for i in range(self.count)]
+
+    # shared=True places the table in shared memory. Other processes attach to it by passing the sharedName
+    # of the creating table together with the same size.
+    def __init__(self, sizeMB, shared=False, sharedName=None):
         self.enabled = True
-    
+        self.generation = 0
+        # How many plies of depth one search generation of age is worth when choosing an entry to replace
+        self.agePenalty = 8
+        # A store for a position already in the table only replaces an entry of the current search when it is exact
+        # or at most this many plies shallower; otherwise the deeper result is kept
+        self.sameKeyDepthMargin = 3
+        self.shared = shared
+        self.sharedMemory = None
+        self.ownsSharedMemory = False
+        self.Resize(sizeMB, sharedName)
+
+    def Resize(self, sizeMB, sharedName=None):
+        self.Close()
+        self.sizeMB = sizeMB
+        self.numBuckets = max(1, int(sizeMB * 1024 * 1024) // (ttEntrySizeBytes * bucketSize))
+        self.count = self.numBuckets * bucketSize
+        if not self.shared:
+            self.Clear()
+            return
+
+        if sharedName is None:
+            self.sharedMemory = shared_memory.SharedMemory(create=True, size=self.count * ttEntrySizeBytes)
+            self.ownsSharedMemory = True
+        else:
+            self.sharedMemory = shared_memory.SharedMemory(name=sharedName)
+        buffer = self.sharedMemory.buf
+        self.keys = buffer[:self.count * 8].cast('Q')
+        self.data = buffer[self.count * 8:self.count * ttEntrySizeBytes].cast('Q')
+        if self.ownsSharedMemory:
+            self.Clear()
+
+    # Moves the table between private and shared storage; passing sharedName attaches to another process' table
+    def SetShared(self, shared, sharedName=None):
+        self.Close()
+        self.shared = shared
+        self.Resize(self.sizeMB, sharedName)
+
     def Clear(self):
-        self.entries = [Entry(0, 0, 0, 0, chess.Move.null()) for i in range(self.count)]
-        
-    def Index(self):
-        return chess.polyglot.zobrist_hash(self.board) % self.count
-    
-    def TryGetStoredMove(self):
-        return self.entries[self.Index()].move
-    
+        if self.sharedMemory is not None:
+            self.sharedMemory.buf[:self.count * ttEntrySizeBytes] = bytes(self.count * ttEntrySizeBytes)
+            return
+        # Building the arrays from a zeroed buffer is a single memcpy, not one python object per entry
+        zeroes = bytes(8 * self.count)
+        self.keys = array('Q', zeroes)
+        self.data = array('Q', zeroes)
+
+    # Releases the shared memory segment; the process that created it also destroys it
+    def Close(self):
+        if self.sharedMemory is None:
+            return
+        self.keys.release()
+        self.data.release()
+        self.keys = self.data = None
+        self.sharedMemory.close()
+        if self.ownsSharedMemory:
+            self.sharedMemory.unlink()
+        self.sharedMemory = None
+        self.ownsSharedMemory = False
+
+    def SharedName(self):
+        return self.sharedMemory.name if self.sharedMemory is not None else None
+
+    def SizeBytes(self):
+        return self.keys.itemsize * len(self.keys) + self.data.itemsize * len(self.data)
+
+    # Called once per search: entries written by earlier searches stay usable but become the first to be replaced.
+    # Processes sharing the table pass the generation chosen by the main process.
+    def NewSearch(self, generation=None):
+        self.generation = (self.generation + 1) & generationMask if generation is None else generation
+        return self.generation
+
+    def Index(self, key):
+        return (key % self.numBuckets) * bucketSize
+
+    # Returns the slot and data word of the entry for this key, or (-1, 0) on a miss.
+    # The data word is read once and validated against the key, so it cannot be torn by a concurrent writer.
+    def Probe(self, key):
+        index = (key % self.numBuckets) * bucketSize
+        keys = self.keys
+        data = self.data
+        for i in range(index, index + bucketSize):
+            entryData = data[i]
+            if keys[i] ^ entryData == key:
+                return i, entryData
+        return -1, 0
+
+    def Write(self, index, key, data):
+        self.data[index] = data
+        self.keys[index] = key ^ data
+
+    def TryGetStoredMove(self, key):
+        index, data = self.Probe(key)
+        if index < 0:
+            return chess.Move.null()
+        return UnpackMove(data)
+
     def CorrectRetrievedMateScore(self, score, numPlySearched):
         if IsMateScore(score):
             sign = 1 if score > 0 else -1
             return (score * sign - numPlySearched) * sign
 
         return score
-    
+
     def CorrectMateScoreForStorage(self, score, numPlySearched):
         if IsMateScore(score):
             sign = 1 if score > 0 else -1
             return (score * sign + numPlySearched) * sign
 
         return score
-    
-    def LookupEvaluation(self, depth, plyFromRoot, alpha, beta):
+
+    def LookupEvaluation(self, key, depth, plyFromRoot, alpha, beta):
         if not self.enabled:
-            return self.LookupFailed
-        
-        entry: Entry = self.entries[self.Index()]
-        if entry.key == chess.polyglot.zobrist_hash(self.board):
-            if entry.depth >= depth:
-                correctedScore = self.CorrectRetrievedMateScore(entry.value, plyFromRoot)
-
-                if entry.nodeType == Exact:
+            return LookupFailed
+
+        index, data = self.Probe(key)
+        if index >= 0:
+            if UnpackGeneration(data) != self.generation:
+                data = (data & ~(generationMask << generationShift)) | (self.generation << generationShift)
+                self.Write(index, key, data)
+            if UnpackDepth(data) >= depth:
+                correctedScore = self.CorrectRetrievedMateScore(UnpackScore(data), plyFromRoot)
+                bound = UnpackBound(data)
+
+                if bound == Exact:
                     return correctedScore
-                
-                if entry.nodeType == UpperBound and correctedScore <= alpha:
+
+                if bound == UpperBound and correctedScore <= alpha:
                     return correctedScore
-                
-                if entry.nodeType == LowerBound and correctedScore >= beta:
+
+                if bound == LowerBound and correctedScore >= beta:
                     return correctedScore
         return LookupFailed
-                
-    def StoreEvaluation(self, depth, numPlySearched, eval, evalType, move:chess.Move):
+
+    def StoreEvaluation(self, key, depth, numPlySearched, eval, evalType, move:chess.Move):
         if not self.enabled:
             return
-        
-        index = self.Index()
-        entry = Entry(chess.polyglot.zobrist_hash(self.board), self.CorrectMateScoreForStorage(eval, numPlySearched), depth, evalType, move)
-        self.entries[index] = entry
-        
-    def getEntry(self, zobristKey):
-        return self.entries[zobristKey % self.count]
-    
-        
-        
-    
+
+        index, previousData = self.ReplacementIndex(key)
+        encodedMove = EncodeMove(move)
+        if previousData:
+            if (evalType != Exact and depth < UnpackDepth(previousData) - self.sameKeyDepthMargin
+                    and UnpackGeneration(previousData) == self.generation):
+                # Keep the deeper result, only filling in a best move it lacks
+                if encodedMove and not previousData & moveMask:
+                    self.Write(index, key, previousData | encodedMove)
+                return
+            if not encodedMove:
+                # Keep the best move of a previous search of this position when this one failed low
+                encodedMove = previousData & moveMask
+        self.Write(index, key, PackData(self.CorrectMateScoreForStorage(eval, numPlySearched), depth, evalType, encodedMove, self.generation))
+
+    # Same position if present (returned with its data word), otherwise the slot holding the least valuable entry:
+    # the shallowest one, where every search generation of age counts as agePenalty plies less depth
+    def ReplacementIndex(self, key):
+        bucket = (key % self.numBuckets) * bucketSize
+        keys = self.keys
+        data = self.data
+        replaceIndex = bucket
+        replaceWorth = INF
+        for i in range(bucket, bucket + bucketSize):
+            entryData = data[i]
+            if keys[i] ^ entryData == key:
+                return i, entryData
+            if entryData == 0:
+                worth = -INF
+            else:
+                age = (self.generation - UnpackGeneration(entryData)) & generationMask
+                worth = UnpackDepth(entryData) - self.agePenalty * age
+            if worth < replaceWorth:
+                replaceWorth = worth
+                replaceIndex = i
+        return replaceIndex, 0
+
+    # Permille of sampled entries written or used by the current search, as reported in UCI 'hashfull'
+    def HashFull(self):
+        sampleSize = min(1000, self.count)
+        used = 0
+        for i in range(sampleSize):
+            entryData = self.data[i]
+            if entryData != 0 and UnpackGeneration(entryData) == self.generation:
+                used += 1
+        return used * 1000 // sampleSize
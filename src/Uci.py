@@ -1,12 +1,18 @@
 import chess
 from Bot import Bot
 from Evaluation import Evaluation
+from Perft import PrintDivide
+from Benchmark import RunBenchmark, PrintResult, benchDepth
 class UCI:
     def __init__(self, board: chess.Board):
         self.positionLabels = ["position", "fen", "moves"]
-        self.goLabels = ["go", "movetime", "wtime", "btime", "winc", "binc", "movestogo"]
+        self.goLabels = ["go", "movetime", "wtime", "btime", "winc", "binc", "movestogo", "ponder", "infinite", "depth", "nodes", "mate", "perft"]
+        self.optionLabels = ["setoption", "name", "value"]
         self.bot = Bot(board)
         self.board = board
+        # Start position and moves of the last position command, so that a command continuing the same game only plays the new moves
+        self.positionFen = None
+        self.positionMoves = []
         self.evaluation = Evaluation()
         
     def ReceiveCommand(self, message):
@@ -14,19 +20,40 @@ class UCI:
         if messageType == "uci":
             print("id name OBSIDIAN")
             print("id author Imran AKKI")
+            print(f"option name Hash type spin default {self.bot.searcher.transpositionTableSizeMB} min 1 max 4096")
+            print(f"option name EvalCache type spin default {self.bot.searcher.evaluation.evalCache.sizeMB} min 0 max 1024")
+            print(f"option name Threads type spin default {self.bot.numThreads} min 1 max 64")
+            print("option name Ponder type check default false")
             print("uciok")
         elif messageType == "isready":
             print("readyok")
         elif messageType == "ucinewgame":
+            self.bot.StopThinking()
             self.bot.NotifyNewGame()
+            self.positionFen = None
+            self.positionMoves = []
+        elif messageType == "debug":
+            self.bot.SetDebugMode(message.split(" ")[-1].lower() == "on")
+        elif messageType == "setoption":
+            self.bot.StopThinking()
+            self.ProcessSetOptionCommand(message)
         elif messageType == "position":
+            self.bot.StopThinking()
             self.ProcessPositionCommand(message)
         elif messageType == "go":
             self.ProcessGoCommand(message)
+        elif messageType == "ponderhit":
+            self.bot.PonderHit()
         elif messageType == "stop":
             self.bot.StopThinking()
         elif messageType == "quit":
+            self.bot.Quit()
             exit()
+        elif messageType == "bench":
+            # Fixed depth search of the benchmark positions; the node count identifies the search version
+            self.bot.StopThinking()
+            words = message.split()
+            PrintResult(RunBenchmark(int(words[1]) if len(words) > 1 else benchDepth, components=False))
         elif messageType == "eval":
             print(self.evaluation.Evaluate(self.board))
         elif messageType == "d":
@@ -47,6 +74,16 @@ class UCI:
         
         return default_value
 
+    def ProcessSetOptionCommand(self, message):
+        name = self.tryGetLabelledValue(message, "name", self.optionLabels).lower()
+        value = self.tryGetLabelledValue(message, "value", self.optionLabels)
+        if name == "hash":
+            self.bot.SetHashSize(max(1, min(4096, int(value))))
+        elif name == "evalcache":
+            self.bot.SetEvalCacheSize(max(0, min(1024, int(value))))
+        elif name == "threads":
+            self.bot.SetThreads(max(1, min(64, int(value))))
+
     def ProcessPositionCommand(self, message:str):
         moves_idx = message.find('moves')
         uci_parameters = message.split(' ')
@@ -64,14 +101,30 @@ class UCI:
                 fenpart = message
 
             _, _, fen = fenpart.split(' ', 2)
+            fen = fen.strip()
         elif uci_parameters[1] == 'startpos':
             fen = chess.STARTING_FEN
         else:
             raise SyntaxError("UCI Syntax error.")
 
-        # start board and make moves
-        self.board.set_fen(fen)
-        for move in moveslist:
+        if fen == self.positionFen and len(self.board.move_stack) == len(self.positionMoves):
+            # Same game: take back the moves that differ from the last command and play only the new ones
+            numCommonMoves = 0
+            for previousMove, move in zip(self.positionMoves, moveslist):
+                if previousMove != move:
+                    break
+                numCommonMoves += 1
+            for _ in range(len(self.positionMoves) - numCommonMoves):
+                self.board.pop()
+            newMoves = moveslist[numCommonMoves:]
+        else:
+            # start board and make moves
+            self.board.set_fen(fen)
+            newMoves = moveslist
+
+        self.positionFen = fen
+        self.positionMoves = moveslist
+        for move in newMoves:
             self.board.push_uci(move)
         
         self.bot.board = self.board
@@ -79,18 +132,28 @@ class UCI:
                 
     def ProcessGoCommand(self, message):
         timeMs = 0
+        maxTimeMs = None
+        words = message.split()
+        if "perft" in words:
+            # Move generation count of the current position, one line per root move; runs to completion
+            self.bot.StopThinking()
+            PrintDivide(self.board, int(self.tryGetLabelledValue(message, "perft", self.goLabels, 1)), True, self.bot.numThreads)
+            return
+        infinite = "infinite" in words
+        maxDepth = int(self.tryGetLabelledValue(message, "depth", self.goLabels, 256))
+        maxNodes = int(self.tryGetLabelledValue(message, "nodes", self.goLabels, 0))
+        mateInMoves = int(self.tryGetLabelledValue(message, "mate", self.goLabels, 0))
         if "movetime" in message:
             timeMs = int(self.tryGetLabelledValue(message, "movetime", self.goLabels, 0))
-        elif "wtime" in message:
+        elif "wtime" in message or "btime" in message:
             timeRemainingWhiteMs = int(self.tryGetLabelledValue(message, "wtime", self.goLabels, 0))
             timeRemainingBlackMs = int(self.tryGetLabelledValue(message, "btime", self.goLabels, 0))
             incrementWhiteMs = int(self.tryGetLabelledValue(message, "winc", self.goLabels, 0))
             incrementBlackMs = int(self.tryGetLabelledValue(message, "binc", self.goLabels, 0))
-            timeMs = self.bot.ChooseThinkTime(timeRemainingWhiteMs, timeRemainingBlackMs, incrementWhiteMs, incrementBlackMs)
-        
+            movesToGo = int(self.tryGetLabelledValue(message, "movestogo", self.goLabels, 0))
+            timeMs, maxTimeMs = self.bot.ChooseThinkTime(timeRemainingWhiteMs, timeRemainingBlackMs, incrementWhiteMs, incrementBlackMs, movesToGo)
+        elif infinite or "depth" in words or "nodes" in words or "mate" in words:
+            timeMs = None
         else:
             timeMs = 60000
-        self.bot.ThinkTimed(timeMs)
-    
-    
-            
\ No newline at end of file
+        self.bot.ThinkTimed(timeMs, maxTimeMs, "ponder" in words, infinite, maxDepth, maxNodes, mateInMoves)
@@ -0,0 +1,161 @@
+import chess
+import chess.polyglot
+
+# Incremental polyglot zobrist keys.
+# The keys produced here match chess.polyglot.zobrist_hash so that the search, the opening book
+# and the debug cross-check all agree on the same numbers.
+
+randomArray = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+
+# pieceKeys[color][pieceType][square]
+pieceKeys = [[[0] * 64 for _ in range(7)] for _ in range(2)]
+for color in chess.COLORS:
+    for pieceType in chess.PIECE_TYPES:
+        for square in chess.SQUARES:
+            pieceKeys[color][pieceType][square] = randomArray[64 * ((pieceType - 1) * 2 + color) + square]
+
+castlingSquares = [chess.H1, chess.A1, chess.H8, chess.A8]
+castlingKeys = [randomArray[768 + i] for i in range(4)]
+epKeys = [randomArray[772 + file] for file in range(8)]
+turnKey = randomArray[780]
+
+
+def FullKey(board: chess.Board):
+    return chess.polyglot.zobrist_hash(board)
+
+# Key of the pawns and kings only, for tables of terms that depend on nothing else (the pawn hash).
+# A Position keeps it up to date as pawnKingKey.
+def PawnKingKey(board: chess.Board):
+    key = 0
+    for color in chess.COLORS:
+        for pieceType in (chess.PAWN, chess.KING):
+            for square in chess.scan_forward(board.pieces_mask(pieceType, color)):
+                key ^= pieceKeys[color][pieceType][square]
+    return key
+
+def CastlingKey(castlingRights):
+    key = 0
+    for i in range(4):
+        if castlingRights & chess.BB_SQUARES[castlingSquares[i]]:
+            key ^= castlingKeys[i]
+    return key
+
+# The en passant file is only hashed when a pawn of the side to move stands next to the double-pushed pawn
+def EpKey(board: chess.Board):
+    epSquare = board.ep_square
+    if epSquare is None:
+        return 0
+    if board.turn == chess.WHITE:
+        epMask = chess.BB_SQUARES[epSquare - 8]
+    else:
+        epMask = chess.BB_SQUARES[epSquare + 8]
+    epMask = chess.shift_left(epMask) | chess.shift_right(epMask)
+    if epMask & board.pawns & board.occupied_co[board.turn]:
+        return epKeys[epSquare & 7]
+    return 0
+
+# Piece placement part of the key change caused by a move. Must be called before the move is pushed.
+def MovePieceKey(board: chess.Board, move: chess.Move):
+    fromSq = move.from_square
+    toSq = move.to_square
+    color = board.turn
+    pieceType = board.piece_type_at(fromSq)
+    keys = pieceKeys[color]
+    key = keys[pieceType][fromSq]
+
+    if pieceType == chess.KING and (board.occupied_co[color] & chess.BB_SQUARES[toSq] or abs((toSq & 7) - (fromSq & 7)) > 1):
+        kingSide = (toSq & 7) > (fromSq & 7)
+        backRank = fromSq & ~7
+        if board.rooks & board.occupied_co[color] & chess.BB_SQUARES[toSq]:
+            rookFrom = toSq
+        else:
+            rookFrom = backRank + (7 if kingSide else 0)
+        kingTo = backRank + (6 if kingSide else 2)
+        rookTo = backRank + (5 if kingSide else 3)
+        return key ^ keys[chess.KING][kingTo] ^ keys[chess.ROOK][rookFrom] ^ keys[chess.ROOK][rookTo]
+
+    capturedType = board.piece_type_at(toSq)
+    if capturedType:
+        key ^= pieceKeys[not color][capturedType][toSq]
+    elif pieceType == chess.PAWN and toSq == board.ep_square:
+        key ^= pieceKeys[not color][chess.PAWN][toSq - 8 if color == chess.WHITE else toSq + 8]
+
+    return key ^ keys[move.promotion or pieceType][toSq]
+
+# Pushes the move (or a null move) onto the board and returns the key of the resulting position
+def PushWithKey(board: chess.Board, key, move: chess.Move):
+    key ^= turnKey ^ EpKey(board)
+    if move:
+        key ^= MovePieceKey(board, move)
+    castlingRights = board.castling_rights
+    board.push(move)
+    if board.castling_rights != castlingRights:
+        key ^= CastlingKey(castlingRights) ^ CastlingKey(board.castling_rights)
+    return key ^ EpKey(board)
+
+
+# Keeps the zobrist key of a board in step with its push/pop calls.
+# keys[i] is the key of the position before the i-th move of the board's move stack, keys[-1] is the current key.
+class KeyStack:
+    def __init__(self, board: chess.Board):
+        self.debug = False
+        self.board = None
+        self.moves = []
+        self.keys = []
+        self.Reset(board)
+
+    # Bring the key history in line with the board's game.
+    # When the board continues the game already known (same root, same earlier moves) only the new moves are hashed,
+    # otherwise the whole move stack is replayed once from the root position.
+    def Reset(self, board: chess.Board):
+        moveStack = board.move_stack
+        numKnownMoves = len(self.moves) if board is self.board and len(self.moves) <= len(moveStack) else -1
+        if numKnownMoves < 0 or moveStack[:numKnownMoves] != self.moves or FullKey(board.root()) != self.keys[0]:
+            self.board = board
+            replay = board.root()
+            self.keys = [FullKey(replay)]
+            numKnownMoves = 0
+        else:
+            self.keys = self.keys[:numKnownMoves + 1]
+            replay = board.copy()
+            for _ in range(len(moveStack) - numKnownMoves):
+                replay.pop()
+        for move in moveStack[numKnownMoves:]:
+            self.keys.append(PushWithKey(replay, self.keys[-1], move))
+        self.moves = list(moveStack)
+
+    # Continue the key history on another board object holding the same position, e.g. the copy a search works on
+    def Attach(self, board: chess.Board):
+        self.board = board
+
+    def Current(self):
+        return self.keys[-1]
+
+    def Push(self, move: chess.Move):
+        self.keys.append(PushWithKey(self.board, self.keys[-1], move))
+        if self.debug:
+            self.Verify()
+
+    def Pop(self):
+        self.keys.pop()
+        self.board.pop()
+
+    def Verify(self):
+        fullKey = FullKey(self.board)
+        if self.keys[-1] != fullKey:
+            raise AssertionError(f"Incremental zobrist key {self.keys[-1]:016x} does not match full hash {fullKey:016x} after {self.board.move_stack[-1] if self.board.move_stack else 'root'} in {self.board.fen()}")
+
+    # Same rule as chess.Board.is_repetition(): the current position occurred at least count times.
+    # A capture or pawn move can never be undone, so only the positions since the last one (the halfmove clock)
+    # with the same side to move are compared.
+    def IsRepetition(self, count=3):
+        keys = self.keys
+        key = keys[-1]
+        occurrences = 1
+        last = len(keys) - 1
+        for i in range(last - 2, max(-1, last - self.board.halfmove_clock - 1), -2):
+            if keys[i] == key:
+                occurrences += 1
+                if occurrences >= count:
+                    return True
+        return False
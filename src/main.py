@@ -1,8 +1,23 @@
 import chess
+import multiprocessing
+import sys
 from Uci import UCI
 
-board = chess.Board()
-uci = UCI(board)
-while True:
-    text = input()
-    uci.ReceiveCommand(text)
\ No newline at end of file
+if __name__ == "__main__":
+    # Lazy SMP helpers are spawned processes, which also need this in the frozen executable
+    multiprocessing.freeze_support()
+    # Searches print from a background thread, so every line has to reach the GUI as soon as it is written
+    sys.stdout.reconfigure(line_buffering=True)
+    board = chess.Board()
+    uci = UCI(board)
+    # 'main.py bench [depth]' runs the benchmark and exits
+    if len(sys.argv) > 1:
+        uci.ReceiveCommand(" ".join(sys.argv[1:]))
+        uci.ReceiveCommand("quit")
+    # This thread only reads commands; searches run in the background so stop, isready and quit are answered at once
+    while True:
+        try:
+            text = input()
+        except EOFError:
+            text = "quit"
+        uci.ReceiveCommand(text)